@@ -13,6 +13,97 @@ MAX_RETRIES = 5
 SLEEP_S = 2
 # Maximum number of gates per module instance in BESS. Don't change it.
 MAX_GATES = 8192
+# Entries of a table created with entries=0 (BESS default)
+DEFAULT_TABLE_ENTRIES = 1 << 15
+# Distinct masks a WildcardMatch holds, each in a table of its own
+MAX_TUPLES = 16
+# upf.json table_sizes key, Parser attribute and hash key length in bytes
+TABLE_SIZES = [('pdrLookup', 'table_size_pdr_lookup', 24),
+               ('flowMeasure', 'table_size_flow_measure', 16),
+               ('appQERLookup', 'table_size_app_qer_lookup', 16),
+               ('sessionQERLookup', 'table_size_session_qer_lookup', 16),
+               ('farLookup', 'table_size_far_lookup', 16)]
+# QoS config the running pipeline was loaded or last reloaded with
+QOS_STATE_FILE = '/tmp/upf-qos.json'
+# IPDefrag bucket entries (IP_FRAG_TBL_BUCKET_ENTRIES) and bytes per entry
+DEFRAG_BUCKET_ENTRIES = 16
+DEFRAG_ENTRY_SIZE = 192
+# Options of an interface's upf.json af_xdp block and their types:
+#  start_queue: first NIC queue to bind, lower ones stay free for other XDP programs
+#  zero_copy: false forces copy mode, by default the driver picks zero-copy if it can
+#  busy_budget: packets per preferred busy poll, 0 to turn busy polling off
+#  shared_umem: let the queues of a port share one UMEM
+AF_XDP_OPTIONS = {"start_queue": int, "zero_copy": bool,
+                  "busy_budget": int, "shared_umem": bool}
+# Options of an interface's upf.json af_packet and slow_af_packet blocks:
+#  blocksz, framesz, framecnt: ring block and frame bytes and frames per queue
+#  fanout_mode: how PACKET_FANOUT spreads packets over the queues
+AF_PACKET_OPTIONS = {"blocksz": int, "framesz": int, "framecnt": int,
+                     "fanout_mode": str}
+AF_PACKET_FANOUT_MODES = ["hash", "lb", "cpu", "rollover", "rnd", "qm"]
+# net_af_packet ring defaults, a page per block
+AF_PACKET_RING = {"blocksz": 4096, "framesz": 2048, "framecnt": 512}
+
+
+def af_xdp_devargs(block, where):
+    # net_af_xdp devargs of an af_xdp block, invalid options are left out
+    devargs = {}
+    if not isinstance(block, dict):
+        print('Invalid af_xdp options for {}. Ignoring them.'.format(where))
+        return devargs
+    for key, value in block.items():
+        if key == "":
+            continue
+        kind = AF_XDP_OPTIONS.get(key)
+        if kind is None or type(value) is not kind or (kind is int and value < 0):
+            print('Invalid af_xdp option {}: {} for {}. Ignoring it.'.format(key, value, where))
+        elif key == "zero_copy":
+            if not value:
+                devargs["force_copy"] = 1
+        else:
+            devargs[key] = int(value)
+    return devargs
+
+
+def af_packet_devargs(block, where):
+    # net_af_packet devargs of an af_packet block, invalid options are left
+    # out and a ring the PMD would refuse falls back to its defaults
+    devargs = {}
+    if not isinstance(block, dict):
+        print('Invalid af_packet options for {}. Ignoring them.'.format(where))
+        return devargs
+    for key, value in block.items():
+        if key == "":
+            continue
+        kind = AF_PACKET_OPTIONS.get(key)
+        if kind is None or type(value) is not kind or (kind is int and value <= 0) or \
+                (key == "fanout_mode" and value not in AF_PACKET_FANOUT_MODES):
+            print('Invalid af_packet option {}: {} for {}. Ignoring it.'.format(key, value, where))
+        else:
+            devargs[key] = value
+
+    ring = dict(AF_PACKET_RING)
+    ring.update((k, v) for k, v in devargs.items() if k in AF_PACKET_RING)
+    # Blocks are whole pages holding whole 16 byte aligned frames
+    if ring["blocksz"] % 4096 or ring["blocksz"] & (ring["blocksz"] - 1) or \
+            ring["framesz"] % 16 or ring["blocksz"] % ring["framesz"]:
+        print('Invalid af_packet ring for {}: blocksz {} must be a power of 2 pages'
+              ' holding whole framesz {} (a multiple of 16). Using the defaults.'.format(
+                  where, ring["blocksz"], ring["framesz"]))
+        for key in AF_PACKET_RING:
+            devargs.pop(key, None)
+    return devargs
+
+
+def rte_hash_size(entries, key_len):
+    # Hugepage bytes of a DPDK rte_hash: 64B buckets of 8 slots for the
+    # next power of two, one 16B aligned key slot per entry (+1) and a
+    # ring of 4B free slot indexes. Rule values live on bessd's heap.
+    entries = entries or DEFAULT_TABLE_ENTRIES
+    pow2 = 1 << (entries - 1).bit_length()
+    key_slot = (8 + key_len + 15) // 16 * 16
+    ring = 1 << (entries + 1).bit_length()
+    return pow2 // 8 * 64 + (entries + 1) * key_slot + ring * 4
 
 
 # ====================================================
@@ -29,6 +120,7 @@ class Parser:
         self.hwcksum = False
         self.gtppsc = False
         self.ddp = False
+        self.fast_classifier = False
         self.measure_upf = False
         self.mode = None
         self.sim_core = None
@@ -43,19 +135,27 @@ class Parser:
         self.sim_pkt_size = None
         self.sim_total_flows = None
         self.workers = 1
+        self.numa_aware = True
+        self.nonworker_cgroups = []
         self.access_ifname = None
         self.core_ifname = None
         self.interfaces = dict()
+        self.af_xdp_devargs = dict()
+        self.af_packet_devargs = dict()
+        self.slow_af_packet_devargs = dict()
         self.enable_ntf = False
         self.notify_sockaddr = "/tmp/notifycp"
         self.endmarker_sockaddr = "/tmp/pfcpport"
         self.enable_slice_metering = False
+        self.slice_rate_limit_config = None
+        self.qci_qos_config = {}
         self.measure_flow = False
         self.table_size_pdr_lookup = 0
         self.table_size_flow_measure = 0
         self.table_size_app_qer_lookup = 0
         self.table_size_session_qer_lookup = 0
         self.table_size_far_lookup = 0
+        self.pdr_patterns = 1
 
     def parse(self, ifaces):
         # Maximum number of flows to manage ip4 frags for re-assembly
@@ -94,6 +194,12 @@ class Parser:
         except KeyError:
             print('ddp not set, using default software fallback')
 
+        # Classify the common packets with a hash lookup ahead of the BPF
+        try:
+            self.fast_classifier = bool(self.conf["fast_classifier"])
+        except KeyError:
+            print('fast_classifier not set, classifying all packets with BPF')
+
         # Telemtrics
         # See this link for details:
         # https://github.com/NetSys/bess/blob/master/bessctl/module_tests/timestamp.py
@@ -110,6 +216,12 @@ class Parser:
                 self.interfaces[iface] = {'ifname': iface}
                 print('Can\'t read {} interface. Setting it to default ({}).'.format(
                     iface, iface))
+            self.af_xdp_devargs[iface] = af_xdp_devargs(
+                self.interfaces[iface].get("af_xdp", {}), iface)
+            self.af_packet_devargs[iface] = af_packet_devargs(
+                self.interfaces[iface].get("af_packet", {}), iface)
+            self.slow_af_packet_devargs[iface] = af_packet_devargs(
+                self.interfaces[iface].get("slow_af_packet", {}), iface + ' slowpath')
 
         # Detect mode. Default is dpdk
         try:
@@ -141,6 +253,18 @@ class Parser:
         except ValueError:
             print('Invalid workers value! Re-setting # of workers to 1.')
 
+        # Place workers on the NUMA node of the ports
+        try:
+            self.numa_aware = bool(self.conf["numa_aware"])
+        except KeyError:
+            print('numa_aware not set, placing workers next to the ports')
+
+        # Cpuset cgroups holding the tasks to keep off the worker cores
+        try:
+            self.nonworker_cgroups = list(self.conf["nonworker_cgroups"])
+        except KeyError:
+            print('nonworker_cgroups not set, pinning every thread off the worker cores')
+
         # Interface names
         try:
             self.access_ifname = self.conf["access"]["ifname"]
@@ -151,11 +275,9 @@ class Parser:
             print('Can\'t parse interface name(s)! Setting it to default values ({}, {})'.format(
                 "access", "core"))
 
-        # Slice rate limits
-        try:
-            self.conf["slice_rate_limit_config"]
-            self.enable_slice_metering = True
-        except KeyError:
+        # Slice rate limits and QCI burst sizes
+        self.parse_qos()
+        if not self.enable_slice_metering:
             print("No slice rate limit! Disabling meter.")
 
         # UnixPort Paths
@@ -183,12 +305,90 @@ class Parser:
         except KeyError:
             print('Flow measurement function disabled')
 
-        # Table sizes
+        # Table sizes derived from the expected load
+        try:
+            self.size_tables(self.conf["table_sizing"])
+        except KeyError as e:
+            if e.args[0] != "table_sizing":
+                print('Invalid table_sizing, missing {}'.format(e))
+
+        # Table sizes, explicit ones override the derived ones
         try:
-            self.table_size_pdr_lookup = self.conf["table_sizes"]["pdrLookup"]
-            self.table_size_flow_measure = self.conf["table_sizes"]["flowMeasure"]
-            self.table_size_app_qer_lookup = self.conf["table_sizes"]["appQERLookup"]
-            self.table_size_session_qer_lookup = self.conf["table_sizes"]["sessionQERLookup"]
-            self.table_size_far_lookup = self.conf["table_sizes"]["farLookup"]
+            sizes = self.conf["table_sizes"]
         except KeyError:
             print("No explicit table sizes")
+        else:
+            for key, attr, _ in TABLE_SIZES:
+                if key not in sizes:
+                    continue
+                derived = getattr(self, attr)
+                if derived and sizes[key] > 2 * derived:
+                    print('{} of {} is over twice the {} derived from table_sizing'.format(
+                        key, sizes[key], derived))
+                setattr(self, attr, sizes[key])
+
+    def parse_qos(self):
+        # The blocks qos_reload.bess applies to a running pipeline, with
+        # the "" comment keys dropped so that they compare by value
+        def strip(block):
+            return dict((k, v) for k, v in block.items() if k != "")
+
+        try:
+            self.slice_rate_limit_config = strip(self.conf["slice_rate_limit_config"])
+            self.enable_slice_metering = True
+        except KeyError:
+            self.slice_rate_limit_config = None
+            self.enable_slice_metering = False
+        self.qci_qos_config = dict((str(qos["qci"]), strip(qos))
+                                   for qos in self.conf.get("qci_qos_config", []))
+
+    def qos_state(self):
+        return {"slice_rate_limit_config": self.slice_rate_limit_config,
+                "qci_qos_config": self.qci_qos_config}
+
+    def size_tables(self, sizing):
+        # Each session installs one PDR per pattern (mask) and pdrLookup
+        # keeps one table per pattern, QERs have an entry per direction
+        sessions = int(sizing["sessions"])
+        pdrs = int(sizing["pdrsPerSession"])
+        self.pdr_patterns = int(sizing.get("pdrPatterns", pdrs))
+        headroom = 100 + int(sizing.get("headroomPct", 10))
+
+        def entries(n, per=1):
+            # n / per entries plus headroom, rounded up
+            return -(-n * headroom // (per * 100))
+
+        self.table_size_pdr_lookup = entries(sessions * pdrs, self.pdr_patterns)
+        if self.measure_flow:
+            self.table_size_flow_measure = entries(sessions * pdrs)
+        self.table_size_app_qer_lookup = entries(
+            sessions * int(sizing["appQERsPerSession"]) * 2)
+        self.table_size_session_qer_lookup = entries(
+            sessions * int(sizing.get("sessionQERsPerSession", 1)) * 2)
+        self.table_size_far_lookup = entries(sessions * int(sizing["farsPerSession"]))
+        if self.pdr_patterns > MAX_TUPLES:
+            print('pdrPatterns {} exceeds the {} masks pdrLookup can hold'.format(
+                self.pdr_patterns, MAX_TUPLES))
+        print('Table sizes for {} sessions: {}'.format(sessions, ', '.join(
+            '{}={}'.format(key, getattr(self, attr)) for key, attr, _ in TABLE_SIZES)))
+
+    def table_memory(self):
+        # [(module, hugepage bytes)] of the tables up4.bess creates, for
+        # each interface its defrag table
+        memory = []
+        for key, attr, key_len in TABLE_SIZES:
+            size = rte_hash_size(getattr(self, attr), key_len)
+            if key == 'pdrLookup':
+                size *= min(self.pdr_patterns, MAX_TUPLES)
+            elif key == 'flowMeasure':
+                if not self.measure_flow:
+                    continue
+                # Double buffered, before QoS and after it per direction
+                size *= 2 * 3
+            memory.append((key, size))
+        if self.max_ip_defrag_flows is not None:
+            for iface in sorted(self.interfaces):
+                memory.append(('{}IP4Defrag'.format(self.interfaces[iface]['ifname']),
+                               self.max_ip_defrag_flows * DEFRAG_BUCKET_ENTRIES *
+                               DEFRAG_ENTRY_SIZE))
+        return memory
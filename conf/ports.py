@@ -18,9 +18,36 @@ def setup_globals():
 #       Port Helpers
 # ====================================================
 dpdk_ports = {}
+# MAC to port id map of the last scan, valid while the same PCI devices
+# stay bound to DPDK drivers
+DPDK_PORTS_CACHE = '/tmp/upf-dpdk-ports.json'
+
+
+def load_dpdk_ports(devices, port_mac):
+    # Only trusted when DPDK owns PCI devices to fingerprint; bifurcated
+    # NICs (e.g. mlx5) stay on their kernel driver and are always probed
+    if not devices:
+        return False
+    try:
+        with open(DPDK_PORTS_CACHE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return False
+    if cache.get('devices') != devices or port_mac not in cache.get('ports', {}):
+        return False
+    dpdk_ports.update(cache['ports'])
+    return True
+
+
+def scan_dpdk_ports(port_mac):
+    # port_mac is of the port being set up, a cache without it is stale
+    start = time.time()
+    devices = dpdk_pci_devices()
+    if load_dpdk_ports(devices, port_mac):
+        print('Loaded DPDK ports {} from {} in {:.1f} ms'.format(
+            dpdk_ports, DPDK_PORTS_CACHE, (time.time() - start) * 1000))
+        return True
 
-
-def scan_dpdk_ports():
     idx = 0
     while True:
         try:
@@ -39,18 +66,102 @@ def scan_dpdk_ports():
         # RTE_MAX_ETHPORTS is 32 and we need 2 for vdevs
         if idx == 30:
           break
+    print('Scanned DPDK ports {} in {:.1f} ms ({} probed)'.format(
+        dpdk_ports, (time.time() - start) * 1000, idx))
+
+    if dpdk_ports and devices:
+        try:
+            with open(DPDK_PORTS_CACHE, 'w') as f:
+                json.dump({'devices': devices, 'ports': dpdk_ports}, f)
+        except IOError as e:
+            print('Unable to cache DPDK ports: {}'.format(e))
     return True if dpdk_ports else False
 
 
+def plan_workers(port_nodes, num_workers, cores):
+    # Workers run the whole pipeline and so touch every port; put all of
+    # them on the node holding most ports, ties going to the node with
+    # more usable cores. Returns (node, worker cores), node -1 if NUMA
+    # does not apply and cores are taken in order as before.
+    cpus = cpus_by_numa_node()
+    known = [n for n in port_nodes if n in cpus]
+    if len(cpus) < 2 or not known:
+        return -1, cores[:num_workers]
+
+    def usable(n):
+        return [c for c in cores if c in cpus[n]]
+
+    node = max(set(known), key=lambda n: (known.count(n), len(usable(n))))
+    local = usable(node)
+    workers = local + [c for c in cores if c not in local]
+    return node, workers[:num_workers]
+
+
+def af_xdp_vdev(idx, name, num_q, devargs):
+    # net_af_xdp vdev binding num_q queues from start_queue (default 0)
+    devargs = dict(devargs)
+    start_queue = devargs.pop("start_queue", 0)
+    return "net_af_xdp{},iface={},start_queue={},queue_count={}".format(
+        idx, name, start_queue, num_q) + "".join(
+        ",{}={}".format(k, v) for k, v in sorted(devargs.items()))
+
+
+def af_packet_vdev(idx, name, num_q, devargs):
+    # net_af_packet vdev with num_q queue pairs
+    return "net_af_packet{},iface={},qpairs={}".format(idx, name, num_q) + "".join(
+        ",{}={}".format(k, v) for k, v in sorted(devargs.items()))
+
+
+# ====================================================
+#       Front Door Classifier
+# ====================================================
+# Key of the hash lookup ahead of a port's BPF, at the offsets of an
+# untagged IPv4 packet without options: ethertype, version/IHL, flags and
+# fragment offset, protocol, dst IP, UDP dst port and GTP-U message type
+CLASSIFIER_FIELDS = [{'offset': 12, 'num_bytes': 2},
+                     {'offset': 14, 'num_bytes': 1},
+                     {'offset': 20, 'num_bytes': 2},
+                     {'offset': 23, 'num_bytes': 1},
+                     {'offset': 30, 'num_bytes': 4},
+                     {'offset': 36, 'num_bytes': 2},
+                     {'offset': 43, 'num_bytes': 1}]
+# Misses (ARP, VLAN, IP options, fragments) go on to the BPF
+ClassifierFallbackGate = MAX_GATES - 1
+GTPU_PORT = 2152
+GTPU_ECHO_REQUEST = 0x1
+GTPU_GPDU = 0xff
+
+
+def classifier_rule(gate, priority, dst_ip=None, gtpu_type=None):
+    # WildcardMatch add() arguments matching unfragmented IPv4 packets,
+    # optionally only those to dst_ip and only GTP-U of the given type
+    gtpu = gtpu_type is not None
+    values = [0x0800, 0x45, 0, 17 if gtpu else 0,
+              ip2long(dst_ip) if dst_ip is not None else 0,
+              GTPU_PORT if gtpu else 0, gtpu_type if gtpu else 0]
+    masks = [0xffff, 0xff, 0x3fff, 0xff if gtpu else 0,
+             0xffffffff if dst_ip is not None else 0,
+             0xffff if gtpu else 0, 0xff if gtpu else 0]
+    return {'values': [{'value_int': v} for v in values],
+            'masks': [{'value_int': m} for m in masks],
+            'priority': priority, 'gate': gate}
+
+
 class Port:
     def __init__(self, name, hwcksum, ext_addrs):
         self.name = name
         self.flow_profiles = []
         self.workers = None
-        self.num_q = 1
+        self.num_rx_q = 1
+        self.num_tx_q = 1
+        self.rx_q_workers = [0]
+        self.ring_sizes = {}
         self.fpi = None
         self.fpo = None
         self.bpf = None
+        self.fast_classifier = False
+        self.classifier = None
+        self.classifier_gates = set()
         self.rtr = None
         self.bpfgate = 0
         self.routes_table = None
@@ -58,6 +169,10 @@ class Port:
         self.ext_addrs = ext_addrs
         self.mode = None
         self.hwcksum = hwcksum
+        self.numa = -1
+        self.af_xdp_devargs = {}
+        self.af_packet_devargs = {}
+        self.slow_af_packet_devargs = {}
 
     def bpf_gate(self):
         if self.bpfgate < MAX_GATES - 2:
@@ -66,6 +181,29 @@ class Port:
         else:
             raise Exception('Port {}: Out of BPF gates to allocate'.format(self.name))
 
+    def classify(self, gate, priority, dst_ips=None, gtpu_type=None):
+        # Mirror a BPF filter in the classifier, each dst IP gets a rule
+        if self.classifier is None:
+            return
+        for ip in dst_ips or [None]:
+            self.classifier.add(**classifier_rule(gate, priority, ip, gtpu_type))
+        self.classifier_gates.add(gate)
+
+    def connect_classifier(self):
+        # Once the BPF is wired and its filters mirrored: packets to the
+        # port's own IPs may be control traffic for the kernel and are
+        # left to the BPF, any other IPv4 packet takes BPF's default gate 0
+        if self.classifier is None:
+            return
+        self.classify(ClassifierFallbackGate, 1, ips_by_interface(self.name))
+        self.classify(0, 0)
+        # Each classifier gate leads where the BPF gate of that number does
+        for ogate in bess.get_module_info(self.bpf.name).ogates:
+            if ogate.ogate in self.classifier_gates and ogate.ogate != ClassifierFallbackGate:
+                bess.connect_modules(self.classifier.name, ogate.name, ogate.ogate, ogate.igate)
+        print('Port {}: classifying gates {} by hash lookup, the rest by BPF'.format(
+            self.name, sorted(self.classifier_gates - {ClassifierFallbackGate})))
+
     def detect_mode(self):
         mode = None
         try:
@@ -81,19 +219,53 @@ class Port:
         if iface == "core":
             self.flow_profiles = [6, 9]
 
+    def configure_queues(self, iface):
+        # Optional queue layout of the interface's upf.json block. By
+        # default each worker polls one RX queue and sends on one TX queue
+        num_workers = len(self.workers)
+        self.num_rx_q = int(iface.get("rx_queues", num_workers))
+        self.num_tx_q = int(iface.get("tx_queues", num_workers))
+        self.rx_q_workers = [int(wid) for wid in iface.get(
+            "rx_queue_workers", [qid % num_workers for qid in range(self.num_rx_q)])]
+        self.ring_sizes = {}
+        if "rx_ring_size" in iface:
+            self.ring_sizes["size_inc_q"] = int(iface["rx_ring_size"])
+        if "tx_ring_size" in iface:
+            self.ring_sizes["size_out_q"] = int(iface["tx_ring_size"])
+
+        if self.num_rx_q < 1:
+            raise Exception('Port {}: rx_queues must be at least 1'.format(self.name))
+        # WorkerSplit sends the packets of worker wid to TX queue wid, and
+        # a QueueOut can only be used by a single worker
+        if self.num_tx_q < num_workers:
+            raise Exception('Port {}: {} tx_queues for {} workers, each worker needs'
+                            ' its own'.format(self.name, self.num_tx_q, num_workers))
+        if len(self.rx_q_workers) != self.num_rx_q:
+            raise Exception('Port {}: rx_queue_workers needs a worker for each of the'
+                            ' {} rx_queues'.format(self.name, self.num_rx_q))
+        for wid in self.rx_q_workers:
+            if wid not in self.workers:
+                raise Exception('Port {}: rx_queue_workers has unknown worker {}'
+                                .format(self.name, wid))
+        idle = [wid for wid in self.workers if wid not in self.rx_q_workers]
+        if idle:
+            print('Port {}: workers {} poll none of its RX queues'.format(self.name, idle))
+
     def init_fastpath(self, **kwargs):
         # Initialize PMDPort and RX/TX modules
         name = self.name
+        kwargs.update(self.ring_sizes)
         fast = PMDPort(name="{}Fast".format(name), **kwargs)
         self.fpi = Merge(name="{}PortMerge".format(name))
         self.fpo = WorkerSplit(name="{}QSplit".format(name))
 
-        for qid in range(self.num_q):
+        for qid in range(self.num_rx_q):
             fpi = QueueInc(name="{}Q{}FastPI".format(name, qid), port=fast.name, qid=qid)
             fpi.connect(next_mod=self.fpi)
             # Attach fastpath to worker's root TC
-            fpi.attach_task(wid=qid)
+            fpi.attach_task(wid=self.rx_q_workers[qid])
 
+        for qid in range(self.num_tx_q):
             fpo = QueueOut(name="{}Q{}FastPO".format(name, qid), port=fast.name, qid=qid)
             self.fpo.connect(next_mod=fpo, ogate=qid)
 
@@ -113,9 +285,14 @@ class Port:
     def init_port(self, idx, conf_mode):
 
         name = self.name
-        num_q = len(self.workers)
-        self.num_q = num_q
-        print('Setting up port {} on worker ids {}'.format(name, self.workers))
+        num_rx_q = self.num_rx_q
+        num_tx_q = self.num_tx_q
+        print('Setting up port {} with {} RX queues on worker ids {}, {} TX queues{}'.format(
+            name, num_rx_q, self.rx_q_workers, num_tx_q,
+            ''.join(', {} {}'.format(k, v) for k, v in sorted(self.ring_sizes.items()))))
+
+        # Allocate queues and packet buffers on the port's node
+        on_node = {"socket_id": self.numa} if self.numa >= 0 else {}
 
         # Detect the mode of this interface - DPDK/AF_XDP/AF_PACKET
         if conf_mode is None:
@@ -124,29 +301,48 @@ class Port:
         if conf_mode not in ['af_xdp', 'linux', 'dpdk', 'af_packet', 'sim']:
             raise Exception('Invalid mode: {} selected.'.format(conf_mode))
 
+        if conf_mode in ['af_xdp', 'linux', 'af_packet'] and num_rx_q != num_tx_q:
+            # Kernel sockets come in RX/TX pairs, every RX queue gets polled
+            num_q = max(num_rx_q, num_tx_q)
+            self.rx_q_workers += [qid % len(self.workers) for qid in range(num_rx_q, num_q)]
+            self.num_rx_q = self.num_tx_q = num_rx_q = num_tx_q = num_q
+            print('Port {}: {} mode uses {} RX and TX queue pairs, RX queues on worker ids {}'
+                  .format(name, conf_mode, num_q, self.rx_q_workers))
+
         if conf_mode in ['af_xdp', 'linux']:
             try:
                 # Initialize kernel fastpath.
                 # AF_XDP requires that num_rx_qs == num_tx_qs
-                kwargs = {"vdev" : "net_af_xdp{},iface={},start_queue=0,queue_count={}"
-                          .format(idx, name, num_q), "num_out_q": num_q, "num_inc_q": num_q}
+                num_q = num_rx_q
+                start_queue = self.af_xdp_devargs.get("start_queue", 0)
+                nic_q = rx_queues_by_interface(name)
+                if nic_q and start_queue + num_q > nic_q:
+                    raise Exception('queues {}-{} requested, {} has {}'.format(
+                        start_queue, start_queue + num_q - 1, name, nic_q))
+                vdev = af_xdp_vdev(idx, name, num_q, self.af_xdp_devargs)
+                print('Port {}: AF_XDP vdev {}'.format(name, vdev))
+                kwargs = {"vdev" : vdev, "num_out_q": num_q, "num_inc_q": num_q}
+                kwargs.update(on_node)
                 self.init_fastpath(**kwargs)
-            except:
+            except Exception as e:
                 if conf_mode == 'linux':
-                    print('Failed to create AF_XDP socket for {}. Retrying with AF_PACKET socket...'.format(name))
+                    print('Failed to create AF_XDP socket for {}: {}. Retrying with AF_PACKET socket...'.format(name, e))
                     conf_mode = 'af_packet'
                 else:
-                    print('Failed to create AF_XDP socket for {}. Exiting...'.format(name))
+                    print('Failed to create AF_XDP socket for {}: {}. Exiting...'.format(name, e))
                     sys.exit()
 
         if conf_mode == 'af_packet':
             try:
                 # Initialize kernel fastpath
-                kwargs = {"vdev" : "net_af_packet{},iface={},qpairs={}"
-                          .format(idx, name, num_q), "num_out_q": num_q, "num_inc_q": num_q}
+                num_q = num_rx_q
+                vdev = af_packet_vdev(idx, name, num_q, self.af_packet_devargs)
+                print('Port {}: AF_PACKET vdev {}'.format(name, vdev))
+                kwargs = {"vdev" : vdev, "num_out_q": num_q, "num_inc_q": num_q}
+                kwargs.update(on_node)
                 self.init_fastpath(**kwargs)
-            except:
-                print('Failed to create AF_PACKET socket for {}. Exiting...'.format(name))
+            except Exception as e:
+                print('Failed to create AF_PACKET socket for {}: {}. Exiting...'.format(name, e))
                 sys.exit()
 
         if conf_mode == 'sim':
@@ -162,7 +358,8 @@ class Port:
             kwargs = None
             pci = alias_by_interface(name)
             if pci is not None:
-                kwargs = {"pci": pci, "num_out_q": num_q, "num_inc_q": num_q, "hwcksum": self.hwcksum, "flow_profiles": self.flow_profiles}
+                kwargs = {"pci": pci, "num_out_q": num_tx_q, "num_inc_q": num_rx_q, "hwcksum": self.hwcksum, "flow_profiles": self.flow_profiles}
+                kwargs.update(on_node)
                 try:
                     self.init_fastpath(**kwargs)
                 except:
@@ -172,7 +369,7 @@ class Port:
             if kwargs is None:
                 # Fallback to scanning ports
                 # if port list is empty, scan for dpdk_ports first
-                if not dpdk_ports and scan_dpdk_ports() == False:
+                if not dpdk_ports and scan_dpdk_ports(mac_by_interface(name)) == False:
                     print('Registered dpdk ports do not exist.')
                     sys.exit()
                 # Initialize DPDK fastpath
@@ -180,14 +377,16 @@ class Port:
                 if fidx is None:
                     raise Exception(
                         'Registered port for {} not detected!'.format(name))
-                kwargs = {"port_id": fidx, "num_out_q": num_q, "num_inc_q": num_q, "hwcksum": self.hwcksum, "flow_profiles": self.flow_profiles}
+                kwargs = {"port_id": fidx, "num_out_q": num_tx_q, "num_inc_q": num_rx_q, "hwcksum": self.hwcksum, "flow_profiles": self.flow_profiles}
+                kwargs.update(on_node)
                 self.init_fastpath(**kwargs)
 
             # Initialize kernel slowpath port and RX/TX modules
             try:
                 peer = peer_by_interface(name)
-                vdev = "net_af_packet{},iface={}".format(idx, peer)
-                slow = PMDPort(name="{}Slow".format(name), vdev=vdev)
+                vdev = af_packet_vdev(idx, peer, 1, self.slow_af_packet_devargs)
+                print('Port {}: slowpath AF_PACKET vdev {}'.format(name, vdev))
+                slow = PMDPort(name="{}Slow".format(name), vdev=vdev, **on_node)
                 spi = PortInc(name="{}SlowPI".format(name), port=slow.name)
                 spo = PortOut(name="{}SlowPO".format(name), port=slow.name)
                 qspo = Queue(name="{}QSlowPO".format(name))
@@ -269,15 +468,22 @@ class Port:
             inc = t
 
         if conf_defrag_flows is not None:
-            defrag = IPDefrag(name="{}IP4Defrag".format(self.name), num_flows=conf_defrag_flows, numa=-1)
+            defrag = IPDefrag(name="{}IP4Defrag".format(self.name), num_flows=conf_defrag_flows, numa=self.numa)
             s = Sink(name="{}DefragFail".format(self.name))
             defrag.connect(next_mod=s)
             inc.connect(next_mod=defrag)
             inc = defrag
             gate = 1
 
-        # Connect inc to bpf
-        inc.connect(next_mod=self.bpf, ogate=gate)
+        # Connect inc to bpf, through the classifier (if enabled)
+        if self.fast_classifier:
+            self.classifier = WildcardMatch(name="{}FastClassifier".format(self.name),
+                                            fields=CLASSIFIER_FIELDS)
+            self.classifier.set_default_gate(gate=ClassifierFallbackGate)
+            self.classifier.connect(next_mod=self.bpf, ogate=ClassifierFallbackGate)
+            inc.connect(next_mod=self.classifier, ogate=gate)
+        else:
+            inc.connect(next_mod=self.bpf, ogate=gate)
 
         # Attach nat module (if enabled)
         if self.ext_addrs is not None:
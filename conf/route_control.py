@@ -3,14 +3,27 @@
 # Copyright 2019 Intel Corporation
 
 import argparse
+import asyncio
+import bisect
+import errno
+import functools
+import heapq
+import json
+import math
+import os
+import select
 import signal
+import socket
+import struct
 import sys
 import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # for retrieving neighbor info
-from pyroute2 import IPDB, IPRoute
-
-from scapy.all import *
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE, RTMGRP_NEIGH
 
 try:
     from pybess.bess import *
@@ -20,6 +33,34 @@ except ImportError:
 
 MAX_RETRIES = 5
 SLEEP_S = 2
+# How long to wait for gateways probed at bootstrap to resolve
+RESOLVE_WAIT_S = 1
+# Backoff between probes of an unresolved gateway, doubled per attempt
+PROBE_BACKOFF_S = 1
+PROBE_BACKOFF_MAX_S = 16
+# Maximum number of unresolved gateways being probed
+PROBE_MAX_PENDING = 4096
+# Netlink events buffered between the socket reader and the controller
+EVENT_QUEUE_SIZE = 65536
+# State journal format, and the size below which it is never compacted
+JOURNAL_VERSION = 1
+JOURNAL_COMPACT_MIN = 4096
+# Maximum number of gates per module instance in BESS. Don't change it.
+MAX_GATES = 8192
+# The last gate of each route module is wired to its bad_route Sink
+ROUTE_GATES = MAX_GATES - 1
+# Multipath next hops the kernel no longer forwards to (RTNH_F_DEAD and
+# RTNH_F_LINKDOWN)
+RTNH_F_UNUSABLE = 0x1 | 0x10
+
+# Upper bounds of the latency histogram buckets exported as metrics
+LATENCY_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                     0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Outcome of a single bessd RPC
+DONE = 0
+RETRY = 1
+FAILED = 2
 
 
 class NeighborEntry:
@@ -31,284 +72,934 @@ class NeighborEntry:
         self.route_count = 0
         self.gate_idx = 0
         self.macstr = None
+        self.module = None
+        # ((neighbor_ip, weight), ...) of a multipath route
+        self.nexthops = None
+        # neighbor IP or ECMP group key the route is programmed to
+        self.target = None
 
     def __str__(self):
+        neigh = self.neighbor_ip
+        if self.nexthops:
+            neigh = ','.join('%s*%d' % hop for hop in self.nexthops)
         return ('{neigh: %s, iface: %s, ip-range: %s/%s}' %
-                (self.neighbor_ip, self.iface, self.iprange, self.prefix_len))
+                (neigh, self.iface, self.iprange, self.prefix_len))
+
+
+class GroupEntry:
+    """HashLB module splitting flows across the next hops of ECMP routes.
+
+    Keyed by (iface, nexthops), so routes over the same weighted set of
+    gateways share one group. Each member is an ogate of the group wired
+    to that gateway's Update module.
+    """
+    def __init__(self):
+        self.iface = None
+        self.nexthops = ()
+        self.gate_idx = 0
+        self.module = None
+        # {neighbor_ip: ogate of the group}
+        self.members = {}
+        self.route_count = 0
+
+    def __str__(self):
+        return '{} on {}:{}'.format(
+            ','.join('{}*{}'.format(*hop) for hop in self.nexthops),
+            self.iface + 'Routes', self.gate_idx)
 
 
 def mac2hex(mac):
     return int(mac.replace(':', ''), 16)
 
 
-def send_ping(neighbor_ip):
-    send(IP(dst=neighbor_ip) / ICMP())
-
+def route_key(item):
+    return (item.iface, item.iprange, int(item.prefix_len))
 
-def send_arp(neighbor_ip, src_mac, iface):
-    pkt = Ether(dst="ff:ff:ff:ff:ff:ff") / ARP(pdst=neighbor_ip, hwsrc=src_mac)
-    pkt.show()
-    hexdump(pkt)
-    sendp(pkt, iface=iface)
 
+def gateways(item):
+    if item.nexthops:
+        return [ip for ip, _ in item.nexthops]
+    return [item.neighbor_ip]
 
-def fetch_mac(dip):
-    ip = ''
-    _mac = ''
-    neighbors = ipr.get_neighbours(dst=dip)
-    for i in range(len(neighbors)):
-        for att in neighbors[i]['attrs']:
-            if 'NDA_DST' in att and dip == att[1]:
-                # ('NDA_DST', dip)
-                ip = att[1]
-            if 'NDA_LLADDR' in att:
-                # ('NDA_LLADDR', _mac)
-                _mac = att[1]
-                return _mac
-
-
-def link_modules(server, module, next_module, ogate=0, igate=0):
-    print('Linking {} module'.format(next_module))
-
-    # Pause bess first
-    bess.pause_all()
-    # Connect module to next_module
-    for _ in range(MAX_RETRIES):
-        try:
-            server.connect_modules(module, next_module, ogate, igate)
-        except BESS.Error as e:
-            bess.resume_all()
-            if e.code == errno.EBUSY:
-                break
-            else:
-                return  #raise
-        except Exception as e:
-            print(
-                'Error connecting module {}:{}->{}:{}: {}. Retrying in {} secs...'
-                .format(module, ogate, igate, next_module, e, SLEEP_S))
-            time.sleep(SLEEP_S)
-        else:
-            bess.resume_all()
-            break
-    else:
-        bess.resume_all()
-        print('BESS module connection ({}:{}->{}:{}) failure.'.format(
-            module, ogate, igate, next_module))
-        return
-        #raise Exception('BESS module connection ({}:{}->{}:{}) failure.'.
-        #                format(module, ogate, igate, next_module))
-
-
-def link_route_module(server, gateway_mac, item):
-    iprange = item.iprange
-    prefix_len = item.prefix_len
-    route_module = item.iface + 'Routes'
-    last_module = item.iface + 'Merge'
-    gateway_mac_str = '{:X}'.format(gateway_mac)
-    print('Adding route entry {}/{} for {}'.format(iprange, prefix_len,
-                                                   route_module))
-
-    print('Trying to retrieve neighbor entry {} from neighbor cache'.format(
-        item.neighbor_ip))
-    neighbor_exists = neighborcache.get(item.neighbor_ip)
-
-    # How many gates does this module have?
-    # If entry does not exist, then initialize it
-    if not modgatecnt.get(route_module):
-        modgatecnt[route_module] = 0
-
-    # Compute likely index
-    if neighbor_exists:
-        # No need to create a new Update module
-        gate_idx = neighbor_exists.gate_idx
-    else:
-        # Need to create a new Update module,
-        # so get gate_idx from gate count
-        gate_idx = modgatecnt[route_module]
-
-    # Pause bess first
-    bess.pause_all()
-    # Pass routing entry to bessd's route module
-    for _ in range(MAX_RETRIES):
-        try:
-            server.run_module_command(route_module, 'add',
-                                      'IPLookupCommandAddArg', {
-                                          'prefix': iprange,
-                                          'prefix_len': int(prefix_len),
-                                          'gate': gate_idx
-                                      })
-        except:
-            print('Error adding route entry {}/{} in {}. Retrying in {}sec...'.
-                  format(iprange, prefix_len, route_module, SLEEP_S))
-            time.sleep(SLEEP_S)
-        else:
-            bess.resume_all()
-            break
-    else:
-        bess.resume_all()
-        print('BESS route entry ({}/{}) insertion failure in module {}'.format(
-            iprange, prefix_len, route_module))
-        return
-        #raise Exception('BESS route entry ({}/{}) insertion failure in module {}'.
-        #                format(iprange, prefix_len, route_module))
 
-    if not neighbor_exists:
-        print('Neighbor does not exist')
-        # Create Update module
-        update_module = route_module + 'DstMAC' + gateway_mac_str
+def is_group(target):
+    # Routes target a neighbor IP or an (iface, nexthops) group key
+    return isinstance(target, tuple)
 
-        # Pause bess first
-        bess.pause_all()
-        for _ in range(MAX_RETRIES):
-            try:
-                server.create_module('Update', update_module, {
-                    'fields': [{
-                        'offset': 0,
-                        'size': 6,
-                        'value': gateway_mac
-                    }]
-                })
-            except BESS.Error as e:
-                bess.resume_all()
-                if e.code == errno.EEXIST:
-                    break
-                else:
-                    return  #raise
-            except Exception as e:
-                print(
-                    'Error creating update module {}: {}. Retrying in {} secs...'
-                    .format(update_module, e, SLEEP_S))
-                time.sleep(SLEEP_S)
-            else:
-                bess.resume_all()
-                break
-        else:
-            bess.resume_all()
-            print('BESS module {} creation failure.'.format(update_module))
-            return  #raise Exception('BESS module {} creation failure.'.
-            #        format(update_module))
 
-        print('Update module created')
+def route_target(item, gateway_mac):
+    # A multipath route forwards to the group of its resolved next hops,
+    # or straight to the neighbor if only one of them is resolved
+    if not item.nexthops:
+        return item.neighbor_ip
+    hops = tuple(hop for hop in item.nexthops if hop[0] in gateway_mac)
+    if len(hops) == 1:
+        return hops[0][0]
+    return (item.iface, hops)
 
-        # Connect Update module to route module
-        link_modules(server, route_module, update_module, gate_idx, 0)
 
-        # Connect Update module to dpdk_out module
-        link_modules(server, update_module, last_module, 0, 0)
+def hop_macs(item, gateway_mac):
+    # {neighbor_ip: mac} of the resolved gateways of a route event
+    if item.nexthops:
+        return gateway_mac
+    return {item.neighbor_ip: gateway_mac}
 
-        # Add a new neighbor in neighbor cache
-        neighborcache[item.neighbor_ip] = item
 
-        # Add a record of the affliated gate id
-        item.gate_idx = gate_idx
+def hashlb_gates(members, nexthops):
+    # Weights are honored by giving each next hop a proportional number of
+    # slots in the HashLB gate list
+    unit = functools.reduce(math.gcd, [weight for _, weight in nexthops])
+    gates = []
+    for ip, weight in nexthops:
+        gates += [members[ip]] * (weight // unit)
+    return gates
 
-        # Set the mac str
-        item.macstr = gateway_mac_str
 
-        # Increment global gate count number
-        modgatecnt[route_module] += 1
+@contextmanager
+def bess_paused(bessd):
+    # Pause bess for the duration of the block and account for it
+    start = time.time()
+    bessd.server.pause_all()
+    try:
+        yield
+    finally:
+        bessd.server.resume_all()
+        paused_s = time.time() - start
+        bessd.stats['pauses'] += 1
+        bessd.stats['paused_s'] += paused_s
+        bessd.metrics.paused.observe(paused_s)
 
-        neighbor_exists = item
 
+def rpc(bessd, what, func, *args, ignore=()):
+    # Transient errors are not retried here; the controller requeues the
+    # event after SLEEP_S instead of blocking the event loop.
+    if func.__name__ == 'run_module_command':
+        command = args[1]
     else:
-        print('Neighbor already exists')
+        command = func.__name__
+    start = time.time()
+    try:
+        func(*args)
+    except BESS.Error as e:
+        if e.code in ignore:
+            return DONE
+        print('Error {} on {}: {}'.format(what, bessd, e))
+        return FAILED
+    except Exception as e:
+        print('Error {} on {}: {}. Retrying in {} secs...'.format(
+            what, bessd, e, SLEEP_S))
+        bessd.metrics.rpc_retries[command] += 1
+        return RETRY
+    finally:
+        bessd.metrics.observe_rpc(command, time.time() - start)
+    return DONE
+
+
+class Histogram:
+    """Cumulative histogram over LATENCY_BUCKETS_S."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_S) + 1)
+        self.sum = 0.0
 
-    # Finally increment route count
-    neighborcache[item.neighbor_ip].route_count += 1
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_S, seconds)] += 1
+        self.sum += seconds
 
 
-def del_route_entry(server, item):
-    iprange = item.iprange
-    prefix_len = item.prefix_len
-    route_module = item.iface + 'Routes'
-    last_module = item.iface + 'Merge'
+class Metrics:
+    """Counters and histograms of one bessd, served in Prometheus format.
 
-    neighbor_exists = neighborcache.get(item.neighbor_ip)
-    if neighbor_exists:
-        # Pause bess first
-        bess.pause_all()
-        # Delete routing entry from bessd's route module
-        for i in range(MAX_RETRIES):
-            try:
-                server.run_module_command(route_module, 'delete',
-                                          'IPLookupCommandDeleteArg', {
-                                              'prefix': iprange,
-                                              'prefix_len': int(prefix_len)
-                                          })
-            except:
-                print(
-                    'Error while deleting route entry for {}. Retrying in {} sec...'
-                    .format(route_module, SLEEP_S))
-                time.sleep(SLEEP_S)
-            else:
-                bess.resume_all()
-                break
+    Updates are plain integer operations on the bessd's worker thread, so
+    they are cheap enough for every event. Gauges are read from the
+    controller state and the text is only rendered when scraped.
+    """
+    def __init__(self):
+        self.rpc_latency = {}
+        self.rpc_retries = Counter()
+        self.requeued = 0
+        self.programmed = Histogram()
+        self.paused = Histogram()
+
+    def observe_rpc(self, command, seconds):
+        hist = self.rpc_latency.get(command)
+        if hist is None:
+            hist = self.rpc_latency[command] = Histogram()
+        hist.observe(seconds)
+
+
+def render_metrics():
+    # Per bessd series carry a bessd="host:port" label
+    lines = []
+
+    def header(name, kind, text):
+        lines.append('# HELP route_control_{} {}'.format(name, text))
+        lines.append('# TYPE route_control_{} {}'.format(name, kind))
+
+    def sample(name, value, labels=()):
+        labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+        lines.append('route_control_{}{} {}'.format(
+            name, '{' + labels + '}' if labels else '', value))
+
+    def histogram(name, hist, labels=()):
+        total = 0
+        bounds = [str(b) for b in LATENCY_BUCKETS_S] + ['+Inf']
+        for bound, count in zip(bounds, list(hist.counts)):
+            total += count
+            sample(name + '_bucket', total, labels + (('le', bound),))
+        sample(name + '_sum', hist.sum, labels)
+        sample(name + '_count', total, labels)
+
+    header('netlink_events_total', 'counter',
+           'Netlink events received, by type')
+    for event, count in sorted(netlink_events.items()):
+        sample('netlink_events_total', count, (('type', event),))
+    header('arp_pending', 'gauge', 'Unresolved gateways being probed')
+    sample('arp_pending', len(probes))
+    header('healthy', 'gauge', 'Whether bessd is reachable')
+    for bessd in bessds:
+        sample('healthy', int(bessd.healthy), (('bessd', bessd.url),))
+    header('programmed_latency_seconds', 'histogram',
+           'Time from netlink event to dataplane update')
+    for bessd in bessds:
+        histogram('programmed_latency_seconds', bessd.metrics.programmed,
+                  (('bessd', bessd.url),))
+    header('rpc_latency_seconds', 'histogram',
+           'bessd RPC latency, by command')
+    for bessd in bessds:
+        for command, hist in sorted(bessd.metrics.rpc_latency.items()):
+            histogram('rpc_latency_seconds', hist,
+                      (('bessd', bessd.url), ('command', command)))
+    header('rpc_retries_total', 'counter',
+           'bessd RPCs failed with a transient error, by command')
+    for bessd in bessds:
+        for command, count in sorted(bessd.metrics.rpc_retries.items()):
+            sample('rpc_retries_total', count,
+                   (('bessd', bessd.url), ('command', command)))
+    header('requeued_events_total', 'counter',
+           'Route events requeued after a transient error')
+    for bessd in bessds:
+        sample('requeued_events_total', bessd.metrics.requeued,
+               (('bessd', bessd.url),))
+    header('pause_seconds', 'histogram',
+           'Time the pipeline was held by pause_all')
+    for bessd in bessds:
+        histogram('pause_seconds', bessd.metrics.paused,
+                  (('bessd', bessd.url),))
+    header('neighbors', 'gauge', 'Next hops with an Update module')
+    for bessd in bessds:
+        sample('neighbors', len(bessd.neighborcache), (('bessd', bessd.url),))
+    header('groups', 'gauge', 'ECMP groups splitting flows over next hops')
+    for bessd in bessds:
+        sample('groups', len(bessd.groupcache), (('bessd', bessd.url),))
+    header('routes', 'gauge', 'Routes programmed in the dataplane')
+    for bessd in bessds:
+        sample('routes', len(bessd.routecache), (('bessd', bessd.url),))
+    header('gates_used', 'gauge', 'Gates in use, by route module')
+    for bessd in bessds:
+        for module, gates in sorted(bessd.modgates.items()):
+            sample('gates_used', gates.used,
+                   (('bessd', bessd.url), ('module', module)))
+    return '\n'.join(lines) + '\n'
+
+
+class RouteBatch:
+    """Coalesces route events until the controller applies them.
+
+    Events are buffered for up to `window_s` seconds or `max_events`
+    events, whichever comes first. Only the last event per prefix is kept,
+    so a route that flaps within a window costs at most one update. A zero
+    window applies events as soon as the event queue has been drained.
+    """
+    def __init__(self, window_s, max_events):
+        self.window_s = window_s
+        self.max_events = max_events
+        self.pending = OrderedDict()
+        # earliest arrival time of the events folded into each key
+        self.stamps = {}
+        # failed attempts per key, reset by any newer event
+        self.attempts = {}
+        self.deadline = None
+        # arrival time of the netlink message being parsed
+        self.stamp = None
+
+    def add_route(self, item, gateway_mac):
+        self._queue(route_key(item), ('add', item, gateway_mac))
+
+    def del_route(self, item):
+        self._queue(route_key(item), ('del', item, None))
+
+    def set_mac(self, neighbor_ip, gateway_mac):
+        self._queue(('neigh', neighbor_ip), ('mac', neighbor_ip, gateway_mac))
+
+    def _queue(self, key, event, stamp=None):
+        # Re-insert so that the net event keeps its arrival order
+        self.pending.pop(key, None)
+        self.pending[key] = event
+        self.stamps.setdefault(key, stamp or self.stamp or time.time())
+        self.attempts.pop(key, None)
+        if self.deadline is None:
+            self.deadline = time.time() + self.window_s
+
+    def requeue(self, retry, stamps):
+        for key, event in retry.items():
+            # A newer event for the same prefix supersedes the retry
+            if key in self.pending:
+                continue
+            attempts = self.attempts.get(key, 0) + 1
+            if attempts >= MAX_RETRIES:
+                print('Giving up on {} {} after {} attempts'.format(
+                    event[0], event[1], attempts))
+                continue
+            self._queue(key, event, stamps.get(key))
+            self.attempts[key] = attempts
+
+    def timeout(self):
+        if not self.pending:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def ready(self, idle):
+        if not self.pending:
+            return False
+        if len(self.pending) >= self.max_events:
+            return True
+        if self.window_s == 0:
+            return idle
+        return time.time() >= self.deadline
+
+    def take(self):
+        events, stamps = self.pending, self.stamps
+        self.pending = OrderedDict()
+        self.stamps = {}
+        self.deadline = None
+        return events, stamps
+
+    def merge(self, events, stamps):
+        # Fold in a batch taken from another RouteBatch
+        for key, event in events.items():
+            self._queue(key, event, stamps.get(key))
+
+    def clear(self):
+        self.take()
+        self.attempts.clear()
+
+
+class GateAllocator:
+    """Hands out ogates of a route module, reusing the lowest free one."""
+    def __init__(self, used=()):
+        used = set(used)
+        self.next = max(used) + 1 if used else 0
+        self.free = [gate for gate in range(self.next) if gate not in used]
+        heapq.heapify(self.free)
+        self.used = len(used)
+
+    def alloc(self):
+        if self.free:
+            gate = heapq.heappop(self.free)
+        elif self.next < ROUTE_GATES:
+            gate = self.next
+            self.next += 1
         else:
-            bess.resume_all()
-            print('Route entry deletion failure.')
-            return
-            #raise Exception('Route entry deletion failure.')
+            return None
+        self.used += 1
+        return gate
 
-        print('Route entry {}/{} deleted from {}'.format(
-            iprange, prefix_len, route_module))
+    def release(self, gate):
+        heapq.heappush(self.free, gate)
+        self.used -= 1
 
-        # Decrementing route count for the registered neighbor
-        neighbor_exists.route_count -= 1
-
-        # If route count is 0, then delete the whole module
-        if neighbor_exists.route_count == 0:
-            update_module = route_module + 'DstMAC' + neighbor_exists.macstr
-            # Pause bess first
-            bess.pause_all()
-            for i in range(MAX_RETRIES):
-                try:
-                    server.destroy_module(update_module)
-                except:
-                    print('Error destroying module {}. Retrying in {}sec...'.
-                          format(update_module, SLEEP_S))
-                    time.sleep(SLEEP_S)
+    def __str__(self):
+        return '{}/{} gates in use ({} free below high water mark {})'.format(
+            self.used, ROUTE_GATES, len(self.free), self.next)
+
+
+def apply_route_batch(bessd, events):
+    # Returns the events that hit a transient error and should be retried
+    server = bessd.server
+    retry = OrderedDict()
+
+    # Compute the net set of IPLookup changes against what is programmed
+    adds = []
+    dels = []
+    macs = []
+    for key, (action, item, gateway_mac) in events.items():
+        if action == 'mac':
+            neighbor = bessd.neighborcache.get(item)
+            if neighbor and neighbor.macstr != '{:X}'.format(gateway_mac):
+                macs.append((neighbor, gateway_mac))
+            continue
+        current = bessd.routecache.get(key)
+        if action == 'add':
+            target = route_target(item, gateway_mac)
+            if current and current.target == target:
+                continue
+            if current:
+                dels.append(current)
+            adds.append((item, target, gateway_mac))
+        elif current:
+            dels.append(current)
+
+    # Next hops that need a new module, and the resulting refcounts. A
+    # neighbor is referenced by its routes and by the groups it is in.
+    refcnt = {ip: n.route_count for ip, n in bessd.neighborcache.items()}
+    grpcnt = {key: g.route_count for key, g in bessd.groupcache.items()}
+    new_neighbors = OrderedDict()
+    new_groups = OrderedDict()
+
+    def use_neighbor(iface, ip, gateway_mac):
+        if ip not in bessd.neighborcache and ip not in new_neighbors:
+            new_neighbors[ip] = (iface, gateway_mac)
+            refcnt[ip] = 0
+        refcnt[ip] += 1
+
+    for item in dels:
+        counts = grpcnt if is_group(item.target) else refcnt
+        counts[item.target] = counts.get(item.target, 0) - 1
+    for item, target, gateway_mac in adds:
+        if not is_group(target):
+            use_neighbor(item.iface, target,
+                         hop_macs(item, gateway_mac)[target])
+            continue
+        if target not in bessd.groupcache and target not in new_groups:
+            new_groups[target] = gateway_mac
+            grpcnt[target] = 0
+        grpcnt[target] += 1
+    # Also collect groups left unreferenced by an earlier failed destroy
+    stale_groups = [key for key, cnt in grpcnt.items()
+                    if cnt == 0 and key in bessd.groupcache]
+
+    # When every route of a group moves to the same new set of next hops,
+    # e.g. a path was added or withdrawn, update the group in place so
+    # that its routes keep their IPLookup entries
+    added = {route_key(item): target for item, target, _ in adds}
+    moves = {}
+    for item in dels:
+        if is_group(item.target):
+            moves.setdefault(item.target, set()).add(
+                added.get(route_key(item)))
+    regroups = OrderedDict()
+    for key in stale_groups:
+        new = moves.get(key, set())
+        if len(new) == 1:
+            new = new.pop()
+            if new in new_groups and new not in regroups:
+                regroups[new] = key
+    stale_groups = [key for key in stale_groups
+                    if key not in regroups.values()]
+    inplace = {route_key(item) for item in dels
+               if item.target in regroups.values()}
+    moved = [add for add in adds if route_key(add[0]) in inplace]
+    dels = [item for item in dels if route_key(item) not in inplace]
+    adds = [add for add in adds if route_key(add[0]) not in inplace]
+
+    for key, gateway_mac in new_groups.items():
+        old = bessd.groupcache.get(regroups.get(key))
+        current = set(old.members) if old else set()
+        for ip, _ in key[1]:
+            if ip not in current:
+                use_neighbor(key[0], ip, gateway_mac[ip])
+        for ip in current - {ip for ip, _ in key[1]}:
+            refcnt[ip] -= 1
+    for key in stale_groups:
+        for ip in bessd.groupcache[key].members:
+            refcnt[ip] -= 1
+    # Also collect neighbors left unreferenced by an earlier failed destroy
+    stale_neighbors = [ip for ip, cnt in refcnt.items()
+                       if cnt == 0 and ip in bessd.neighborcache]
+
+    if not adds and not dels and not macs and not moved and \
+            not new_groups and not stale_groups and not stale_neighbors:
+        return retry
+
+    start = time.time()
+    with bess_paused(bessd):
+        for neighbor, gateway_mac in macs:
+            # Rewrite the next hop MAC in place, routes keep their gate
+            result = rpc(bessd, 'clearing module {}'.format(neighbor.module),
+                         server.run_module_command, neighbor.module, 'clear',
+                         'EmptyArg', {})
+            if result == DONE:
+                result = rpc(bessd,
+                             'updating module {}'.format(neighbor.module),
+                             server.run_module_command, neighbor.module,
+                             'add', 'UpdateArg', {
+                                 'fields': [{'offset': 0, 'size': 6,
+                                             'value': gateway_mac}]
+                             })
+            if result == DONE:
+                print('Next hop {} moved from {} to {:X}'.format(
+                    neighbor.neighbor_ip, neighbor.macstr, gateway_mac))
+                neighbor.macstr = '{:X}'.format(gateway_mac)
+                bessd.journal.neighbor(neighbor)
+            elif result == RETRY:
+                retry[('neigh', neighbor.neighbor_ip)] = (
+                    'mac', neighbor.neighbor_ip, gateway_mac)
+
+        modules = {n.module for n in bessd.neighborcache.values()}
+        for ip, (iface, gateway_mac) in new_neighbors.items():
+            route_module = iface + 'Routes'
+            gateway_mac_str = '{:X}'.format(gateway_mac)
+            gates = bessd.modgates.setdefault(route_module, GateAllocator())
+            gate_idx = gates.alloc()
+            if gate_idx is None:
+                print('Out of gates on {} for neighbor {}: {}'.format(
+                    route_module, ip, gates))
+                continue
+            update_module = route_module + 'DstMAC' + gateway_mac_str
+            # The name may be held by a module whose MAC was rewritten
+            if update_module in modules:
+                update_module += 'G{}'.format(gate_idx)
+            # A module created by a previous attempt shows up as EEXIST,
+            # and an existing link as EBUSY, so retries are idempotent
+            result = rpc(bessd,
+                         'creating update module {}'.format(update_module),
+                         server.create_module, 'Update', update_module,
+                         {'fields': [{'offset': 0, 'size': 6,
+                                      'value': gateway_mac}]},
+                         ignore=(errno.EEXIST,))
+            if result == DONE:
+                result = rpc(bessd, 'connecting {}:{}->{}'.format(
+                                 route_module, gate_idx, update_module),
+                             server.connect_modules, route_module,
+                             update_module, gate_idx, 0,
+                             ignore=(errno.EBUSY,))
+            if result == DONE:
+                result = rpc(bessd, 'connecting {}->{}'.format(
+                                 update_module, iface + 'Merge'),
+                             server.connect_modules, update_module,
+                             iface + 'Merge', 0, 0,
+                             ignore=(errno.EBUSY,))
+            if result != DONE:
+                gates.release(gate_idx)
+                continue
+            neighbor = NeighborEntry()
+            neighbor.neighbor_ip = ip
+            neighbor.iface = iface
+            neighbor.gate_idx = gate_idx
+            neighbor.macstr = gateway_mac_str
+            neighbor.module = update_module
+            bessd.neighborcache[ip] = neighbor
+            bessd.journal.neighbor(neighbor)
+            modules.add(update_module)
+
+        for key in new_groups:
+            if key in regroups:
+                result = update_group(bessd, bessd.groupcache[regroups[key]],
+                                      key)
+            else:
+                result = create_group(bessd, key)
+            if result != DONE:
+                # Their routes are retried with the other failed adds
+                for item, _, gateway_mac in moved:
+                    if added[route_key(item)] == key:
+                        retry[route_key(item)] = ('add', item, gateway_mac)
+        for item, target, _ in moved:
+            if target in bessd.groupcache:
+                store_route(bessd, item, target)
+
+        for item in dels:
+            route_module = item.iface + 'Routes'
+            result = rpc(bessd, 'deleting route entry {}/{} from {}'.format(
+                             item.iprange, item.prefix_len, route_module),
+                         server.run_module_command, route_module, 'delete',
+                         'IPLookupCommandDeleteArg', {
+                             'prefix': item.iprange,
+                             'prefix_len': int(item.prefix_len)
+                         })
+            if result == DONE:
+                bessd.routecache.pop(route_key(item), None)
+                bessd.journal.unroute(item)
+                if is_group(item.target):
+                    nexthop = bessd.groupcache.get(item.target)
                 else:
-                    bess.resume_all()
-                    break
+                    nexthop = bessd.neighborcache.get(item.target)
+                if nexthop:
+                    nexthop.route_count -= 1
+            elif result == RETRY:
+                retry[route_key(item)] = ('del', item, None)
+
+        for item, target, gateway_mac in adds:
+            if is_group(target):
+                nexthop = bessd.groupcache.get(target)
             else:
-                bess.resume_all()
-                print('Module {} deletion failure.'.format(update_module))
+                nexthop = bessd.neighborcache.get(target)
+            if not nexthop:
+                # Its Update module or group could not be set up yet
+                retry[route_key(item)] = ('add', item, gateway_mac)
+                continue
+            route_module = item.iface + 'Routes'
+            result = rpc(bessd, 'adding route entry {}/{} in {}'.format(
+                             item.iprange, item.prefix_len, route_module),
+                         server.run_module_command, route_module, 'add',
+                         'IPLookupCommandAddArg', {
+                             'prefix': item.iprange,
+                             'prefix_len': int(item.prefix_len),
+                             'gate': nexthop.gate_idx
+                         })
+            if result == DONE:
+                store_route(bessd, item, target)
+                nexthop.route_count += 1
+            elif result == RETRY:
+                retry[route_key(item)] = ('add', item, gateway_mac)
+
+        for key in stale_groups:
+            group = bessd.groupcache[key]
+            if group.route_count > 0:
+                continue
+            if rpc(bessd, 'destroying group {}'.format(group.module),
+                   server.destroy_module, group.module) != RETRY:
+                del bessd.groupcache[key]
+                bessd.journal.ungroup(key)
+                bessd.modgates[group.iface + 'Routes'].release(group.gate_idx)
+                for ip in group.members:
+                    if ip in bessd.neighborcache:
+                        bessd.neighborcache[ip].route_count -= 1
+
+        for ip in stale_neighbors:
+            neighbor = bessd.neighborcache[ip]
+            if neighbor.route_count > 0:
+                continue
+            if rpc(bessd, 'destroying module {}'.format(neighbor.module),
+                   server.destroy_module, neighbor.module) != RETRY:
+                del bessd.neighborcache[ip]
+                bessd.journal.unneighbor(neighbor)
+                bessd.modgates[neighbor.iface + 'Routes'].release(
+                    neighbor.gate_idx)
+
+    elapsed_ms = (time.time() - start) * 1000
+    bessd.stats['batches'] += 1
+    bessd.stats['batch_events'] += len(events)
+    bessd.stats['max_batch'] = max(bessd.stats['max_batch'], len(events))
+    print('Applied batch of {} events to {} ({} adds, {} deletes, {} new '
+          'neighbors, {} removed neighbors, {} MAC updates, {} new groups, {} '
+          'updated groups, {} removed groups) in one pause of {:.1f} ms '
+          '[batches: {}, avg size: {:.1f}, max size: {}, total paused: {:.1f} ms]'
+          .format(len(events), bessd, len(adds), len(dels), len(new_neighbors),
+                  len(stale_neighbors), len(macs),
+                  len(new_groups) - len(regroups), len(regroups),
+                  len(stale_groups), elapsed_ms, bessd.stats['batches'],
+                  bessd.stats['batch_events'] / bessd.stats['batches'],
+                  bessd.stats['max_batch'], bessd.stats['paused_s'] * 1000))
+    if new_neighbors or stale_neighbors or new_groups or stale_groups:
+        for route_module, gates in bessd.modgates.items():
+            print('{}: {}'.format(route_module, gates))
+    bessd.journal.flush()
+    return retry
+
+
+def store_route(bessd, item, target):
+    # Route events are shared by all bessd instances, so each one keeps a
+    # copy that records where it programmed the route
+    entry = NeighborEntry()
+    entry.__dict__.update(item.__dict__)
+    entry.target = target
+    bessd.routecache[route_key(entry)] = entry
+    bessd.journal.route(entry)
+
+
+def create_group(bessd, key):
+    # Wire a HashLB module between a route module gate and the Update
+    # modules of the next hops
+    server = bessd.server
+    iface, nexthops = key
+    route_module = iface + 'Routes'
+    if any(ip not in bessd.neighborcache for ip, _ in nexthops):
+        return RETRY
+    gates = bessd.modgates.setdefault(route_module, GateAllocator())
+    gate_idx = gates.alloc()
+    if gate_idx is None:
+        print('Out of gates on {} for group {}: {}'.format(
+            route_module, key, gates))
+        return FAILED
+    group = GroupEntry()
+    group.iface = iface
+    group.nexthops = nexthops
+    group.gate_idx = gate_idx
+    group.module = route_module + 'ECMP{}'.format(gate_idx)
+    group.members = {ip: ogate for ogate, (ip, _) in enumerate(nexthops)}
+
+    # Flows are hashed on their 5-tuple so that they stick to one path
+    result = rpc(bessd, 'creating group {}'.format(group.module),
+                 server.create_module, 'HashLB', group.module,
+                 {'gates': hashlb_gates(group.members, nexthops),
+                  'mode': 'l4'},
+                 ignore=(errno.EEXIST,))
+    for ip, ogate in group.members.items():
+        if result == DONE:
+            module = bessd.neighborcache[ip].module
+            result = rpc(bessd, 'connecting {}:{}->{}'.format(
+                             group.module, ogate, module),
+                         server.connect_modules, group.module, module, ogate,
+                         0, ignore=(errno.EBUSY,))
+    if result == DONE:
+        result = rpc(bessd, 'connecting {}:{}->{}'.format(
+                         route_module, gate_idx, group.module),
+                     server.connect_modules, route_module, group.module,
+                     gate_idx, 0, ignore=(errno.EBUSY,))
+    if result != DONE:
+        # Do not leave a half wired module behind for the next attempt
+        rpc(bessd, 'destroying group {}'.format(group.module),
+            server.destroy_module, group.module, ignore=(errno.ENOENT,))
+        gates.release(gate_idx)
+        return result
+
+    for ip in group.members:
+        bessd.neighborcache[ip].route_count += 1
+    bessd.groupcache[key] = group
+    bessd.journal.group(group)
+    print('Created group {}'.format(group))
+    return DONE
+
+
+def update_group(bessd, group, key):
+    # Move a group to a new set of next hops without touching its routes
+    server = bessd.server
+    nexthops = key[1]
+    members = dict(group.members)
+    result = DONE
+    for ip, _ in nexthops:
+        if ip in members:
+            continue
+        if ip not in bessd.neighborcache:
+            return RETRY
+        ogate = min(set(range(len(members) + 1)) - set(members.values()))
+        module = bessd.neighborcache[ip].module
+        result = rpc(bessd, 'connecting {}:{}->{}'.format(
+                         group.module, ogate, module),
+                     server.connect_modules, group.module, module, ogate, 0,
+                     ignore=(errno.EBUSY,))
+        if result != DONE:
+            return result
+        members[ip] = ogate
+        bessd.neighborcache[ip].route_count += 1
+        group.members[ip] = ogate
+        bessd.journal.group(group)
+
+    result = rpc(bessd, 'updating group {}'.format(group.module),
+                 server.run_module_command, group.module, 'set_gates',
+                 'HashLBCommandSetGatesArg',
+                 {'gates': hashlb_gates(members, nexthops)})
+    if result != DONE:
+        return result
+
+    for ip in set(members) - {ip for ip, _ in nexthops}:
+        # A link that fails to go keeps its ogate out of reuse
+        if rpc(bessd, 'disconnecting {}:{}'.format(group.module, members[ip]),
+               server.disconnect_modules, group.module,
+               members[ip]) == DONE:
+            del group.members[ip]
+            bessd.neighborcache[ip].route_count -= 1
+
+    del bessd.groupcache[(group.iface, group.nexthops)]
+    bessd.journal.ungroup((group.iface, group.nexthops))
+    group.nexthops = nexthops
+    bessd.groupcache[key] = group
+    bessd.journal.group(group)
+    print('Updated group {}'.format(group))
+    return DONE
+
+
+def inet_checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def icmp_echo(ident, seq):
+    header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+    return struct.pack('!BBHHH', 8, 0, inet_checksum(header), ident, seq)
+
+
+class ProbeEntry:
+    def __init__(self, neighbor_ip, now, timeout_s):
+        self.neighbor_ip = neighbor_ip
+        # routes waiting for this gateway, keyed by route_key()
+        self.routes = OrderedDict()
+        self.attempts = 0
+        self.next_probe = now
+        self.expires = now + timeout_s
+
+
+class ProbeScheduler:
+    """Pings unresolved gateways so that the kernel resolves them.
+
+    Entries are deduplicated by gateway IP and hold every route waiting on
+    it. Probes go out of one preopened raw ICMP socket, at most `rate` per
+    second, and are retried with exponential backoff until the gateway
+    resolves or `timeout_s` expires, at which point its routes are dropped
+    until the kernel announces them again.
+    """
+    def __init__(self, rate, timeout_s, sock=None):
+        self.rate = rate
+        self.timeout_s = timeout_s
+        self.tokens = rate
+        self.last = time.time()
+        self.pending = OrderedDict()
+        # gateways each waiting route is registered under, by route_key()
+        self.waiting = {}
+        self.seq = 0
+        self.sent = 0
+        self.expired = 0
+        self.sock = sock
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                      socket.IPPROTO_ICMP)
+            self.sock.setblocking(False)
+            # Echo replies are not read, keep their backlog small
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __str__(self):
+        return '{} unresolved gateways for {} routes'.format(
+            len(self.pending),
+            sum(len(e.routes) for e in self.pending.values()))
+
+    def add(self, item, probed=False, neighbor_ip=None):
+        # Multipath routes wait on each of their unresolved gateways
+        neighbor_ip = neighbor_ip or item.neighbor_ip
+        now = time.time()
+        entry = self.pending.get(neighbor_ip)
+        if entry is None:
+            if len(self.pending) >= PROBE_MAX_PENDING:
+                print('Probe table full, dropping route {}'.format(item))
                 return
-                #raise Exception('Module {} deletion failure.'.
-                #                format(update_module))
+            entry = ProbeEntry(neighbor_ip, now, self.timeout_s)
+            if probed:
+                entry.attempts = 1
+                entry.next_probe = now + PROBE_BACKOFF_S
+            self.pending[neighbor_ip] = entry
+            print('Adding entry {} in arp probe table'.format(item))
+        entry.routes[route_key(item)] = item
+        self.waiting.setdefault(route_key(item), set()).add(neighbor_ip)
+
+    def _forget(self, entry):
+        for key in entry.routes:
+            ips = self.waiting.get(key)
+            if ips:
+                ips.discard(entry.neighbor_ip)
+                if not ips:
+                    del self.waiting[key]
+
+    def discard(self, item):
+        # Drops the route from every gateway it waits on, including those
+        # of an older version of it
+        key = route_key(item)
+        for ip in self.waiting.pop(key, ()):
+            entry = self.pending.get(ip)
+            if entry:
+                entry.routes.pop(key, None)
+                if not entry.routes:
+                    del self.pending[ip]
+
+    def resolved(self, neighbor_ip):
+        entry = self.pending.pop(neighbor_ip, None)
+        if not entry:
+            return []
+        self._forget(entry)
+        return list(entry.routes.values())
+
+    def clear(self):
+        self.pending.clear()
+        self.waiting.clear()
+
+    def send(self, neighbor_ip):
+        self.seq = (self.seq + 1) & 0xffff
+        try:
+            self.sock.sendto(icmp_echo(os.getpid() & 0xffff, self.seq),
+                             (neighbor_ip, 0))
+        except OSError as e:
+            print('Error probing {}: {}'.format(neighbor_ip, e))
+            return False
+        self.sent += 1
+        return True
+
+    def timeout(self):
+        if not self.pending:
+            return None
+        now = time.time()
+        due = min(min(e.next_probe, e.expires)
+                  for e in self.pending.values()) - now
+        if self.tokens < 1:
+            due = max(due, (1 - self.tokens) / self.rate)
+        return max(due, 0)
+
+    def tick(self):
+        now = time.time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        sent = 0
+        for ip, entry in list(self.pending.items()):
+            if now >= entry.expires:
+                del self.pending[ip]
+                self._forget(entry)
+                self.expired += 1
+                print('Giving up resolving {} after {} probes, dropping {} '
+                      'routes'.format(ip, entry.attempts, len(entry.routes)))
+            elif now >= entry.next_probe and self.tokens >= 1:
+                self.tokens -= 1
+                entry.attempts += 1
+                entry.next_probe = now + min(
+                    PROBE_BACKOFF_S * 2 ** (entry.attempts - 1),
+                    PROBE_BACKOFF_MAX_S)
+                if self.send(ip):
+                    sent += 1
+        if sent:
+            print('Probed {} gateways, {}'.format(sent, self))
 
-            print('Module {} destroyed'.format(update_module))
 
-            # Delete entry from the neighbor cache
-            del neighborcache[item.neighbor_ip]
-            print('Deleting item from neighborcache')
-            del neighbor_exists
-        else:
-            print('Route count for {}  decremented to {}'.format(
-                item.neighbor_ip, neighbor_exists.route_count))
-            neighborcache[item.neighbor_ip] = neighbor_exists
-    else:
-        print('Neighbor {} does not exist'.format(item.neighbor_ip))
+def send_ping(neighbor_ip):
+    probes.send(neighbor_ip)
 
 
-def probe_addr(item, src_mac):
-    # Store entry if entry does not exist in ARP cache
-    arpcache[item.neighbor_ip] = item
-    print('Adding entry {} in arp probe table'.format(item))
+def arp_request(neighbor_ip, src_mac, src_ip='0.0.0.0'):
+    # Broadcast who-has frame, an RFC 5227 probe unless src_ip is given
+    hwsrc = bytes.fromhex(src_mac.replace(':', ''))
+    return struct.pack('!6s6sH', b'\xff' * 6, hwsrc, 0x0806) + \
+        struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, hwsrc,
+                    socket.inet_aton(src_ip), b'\0' * 6,
+                    socket.inet_aton(neighbor_ip))
 
-    # Probe ARP request by sending ping
-    send_ping(item.neighbor_ip)
 
-    # Probe ARP request
-    ##send_arp(neighbor_ip, src_mac, item.iface)
+def send_arp(neighbor_ip, src_mac, iface):
+    with socket.socket(socket.AF_PACKET, socket.SOCK_RAW) as sock:
+        sock.bind((iface, 0))
+        sock.send(arp_request(neighbor_ip, src_mac))
 
 
-def parse_new_route(msg):
+def fetch_mac(dip):
+    # Answered from the neighbor table kept up to date by netlink events
+    return neighbortable.get(dip)
+
+
+def route_from_msg(msg):
+    # Skip routes out of other interfaces before looking at anything else
+    multipath = get_attr(msg, 'RTA_MULTIPATH')
+    if multipath:
+        # Each next hop carries its own interface, gateway and weight
+        hops = [(ifnames.get(nh['oif']), get_attr(nh, 'RTA_GATEWAY'),
+                 nh['hops'] + 1) for nh in multipath
+                if not nh.get('flags', 0) & RTNH_F_UNUSABLE]
+        hops = [hop for hop in hops if hop[0] and hop[1]]
+        if not hops:
+            return None
+        iface = hops[0][0]
+    else:
+        iface = ifnames.get(get_attr(msg, 'RTA_OIF'))
+        if not iface:
+            return None
+
     item = NeighborEntry()
+    item.iface = iface
     # Fetch prefix_len
     item.prefix_len = msg['dst_len']
     # Default route
-    if item.prefix_len is 0:
+    if item.prefix_len == 0:
         item.iprange = '0.0.0.0'
 
     for att in msg['attrs']:
@@ -317,91 +1008,108 @@ def parse_new_route(msg):
             # ('RTA_DST', iprange)
             item.iprange = att[1]
         if 'RTA_GATEWAY' in att:
-            # Fetch gateway MAC address
             # ('RTA_GATEWAY', neighbor_ip)
             item.neighbor_ip = att[1]
-            _mac = fetch_mac(att[1])
-            if not _mac:
-                gateway_mac = 0
-            else:
-                gateway_mac = mac2hex(_mac)
-        if 'RTA_OIF' in att:
-            # Fetch interface name
-            # ('RTA_OIF', iface)
-            item.iface = ipdb.interfaces[int(att[1])].ifname
 
-    if not item.iface in args.i or not item.iprange or not item.neighbor_ip:
+    if multipath:
+        # Next hops out of other interfaces cannot be reached from here
+        nexthops = {}
+        for hop_iface, gateway, weight in hops:
+            if hop_iface == iface:
+                nexthops[gateway] = nexthops.get(gateway, 0) + weight
+        if len(nexthops) == 1:
+            item.neighbor_ip = next(iter(nexthops))
+        else:
+            item.nexthops = tuple(sorted(nexthops.items()))
+
+    if not item.iprange or not (item.neighbor_ip or item.nexthops):
         # Neighbor info is invalid
-        del item
-        return
+        return None
+    return item
 
-    # if mac is 0, send ARP request
-    if gateway_mac == 0:
-        print('Adding entry {} in arp probe table'.format(item.iface))
-        probe_addr(item, ipdb.interfaces[item.iface].address)
 
-    else:  # if gateway_mac is set
+def queue_route(item):
+    # Batch the route over its resolved gateways and probe the others
+    macs = {}
+    for ip in gateways(item):
+        _mac = fetch_mac(ip)
+        if _mac:
+            macs[ip] = mac2hex(_mac)
+        else:
+            probes.add(item, neighbor_ip=ip)
+    if not macs:
+        return
+
+    if item.nexthops:
+        print('Linking module {}Routes with {}Merge (Next hops: {})'.format(
+            item.iface, item.iface, ', '.join(
+                '{} {:012X}'.format(ip, mac) for ip, mac in macs.items())))
+        batch.add_route(item, macs)
+    else:
         print('Linking module {}Routes with {}Merge (Dest MAC: {})'.format(
-            item.iface, item.iface, _mac))
+            item.iface, item.iface, fetch_mac(item.neighbor_ip)))
+        batch.add_route(item, macs[item.neighbor_ip])
+
 
-        link_route_module(bess, gateway_mac, item)
+def parse_new_route(msg):
+    item = route_from_msg(msg)
+    if not item:
+        return
+
+    # A replaced route no longer waits on the gateways it had before
+    probes.discard(item)
+    queue_route(item)
 
 
 def parse_new_neighbor(msg):
-    for att in msg['attrs']:
-        if 'NDA_DST' in att:
-            # ('NDA_DST', neighbor_ip)
-            neighbor_ip = att[1]
-        if 'NDA_LLADDR' in att:
-            # ('NDA_LLADDR', neighbor_mac)
-            gateway_mac = att[1]
-
-    item = arpcache.get(neighbor_ip)
-    if item:
-        print('Linking module {}Routes with {}Merge (Dest MAC: {})'.format(
-            item.iface, item.iface, gateway_mac))
+    neighbor_ip = get_attr(msg, 'NDA_DST')
+    gateway_mac = get_attr(msg, 'NDA_LLADDR')
+    if not neighbor_ip or not gateway_mac:
+        # Incomplete or failed entries carry no link layer address
+        return
 
-        # Add route entry, and add item in the registered neighbor cache
-        link_route_module(bess, mac2hex(gateway_mac), item)
+    old_mac = neighbortable.get(neighbor_ip)
+    neighbortable[neighbor_ip] = gateway_mac
 
-        # Remove entry from unresolved arp cache
-        del arpcache[neighbor_ip]
+    if old_mac != gateway_mac and \
+            any(neighbor_ip in b.neighborcache for b in bessds):
+        # Next hop failover, rewrite its Update module in place
+        batch.set_mac(neighbor_ip, mac2hex(gateway_mac))
 
+    # Add the routes that were waiting for this gateway
+    for item in probes.resolved(neighbor_ip):
+        queue_route(item)
 
-def parse_del_route(msg):
-    item = NeighborEntry()
-    for att in msg['attrs']:
-        if 'RTA_DST' in att:
-            # Fetch IP range
-            # ('RTA_DST', iprange)
-            item.iprange = att[1]
-        if 'RTA_GATEWAY' in att:
-            # Fetch gateway MAC address
-            # ('RTA_GATEWAY', neighbor_ip)
-            item.neighbor_ip = att[1]
-        if 'RTA_OIF' in att:
-            # Fetch interface name
-            # ('RTA_OIF', iface)
-            item.iface = ipdb.interfaces[int(att[1])].ifname
 
-    if not item.iface in args.i or not item.iprange or not item.neighbor_ip:
-        # Neighbor info is invalid
-        del item
-        return
+def parse_del_neighbor(msg):
+    neighbor_ip = get_attr(msg, 'NDA_DST')
+    if neighbortable.pop(neighbor_ip, None) and \
+            any(neighbor_ip in b.neighborcache for b in bessds):
+        # Routes keep forwarding to the last known MAC, re-resolve it so
+        # that a change shows up as RTM_NEWNEIGH
+        print('Neighbor {} expired, probing it'.format(neighbor_ip))
+        send_ping(neighbor_ip)
 
-    # Fetch prefix_len
-    item.prefix_len = msg['dst_len']
 
-    del_route_entry(bess, item)
+def parse_del_route(msg):
+    item = route_from_msg(msg)
+    if not item:
+        return
 
-    # Delete item
-    del item
+    probes.discard(item)
+    batch.del_route(item)
 
 
-def netlink_event_listener(ipdb, netlink_message, action):
+def netlink_event_listener(netlink_message, action):
 
     # If you get a netlink message, parse it
     msg = netlink_message
+    netlink_events[action] += 1
+
+    # Only IPv4 neighbors on the controlled interfaces can be gateways
+    if action in ('RTM_NEWNEIGH', 'RTM_DELNEIGH') and \
+            (msg['family'] != socket.AF_INET or msg['ifindex'] not in ifnames):
+        return
 
     if action == 'RTM_NEWROUTE':
         parse_new_route(msg)
@@ -409,24 +1117,558 @@ def netlink_event_listener(ipdb, netlink_message, action):
     if action == 'RTM_NEWNEIGH':
         parse_new_neighbor(msg)
 
+    if action == 'RTM_DELNEIGH':
+        parse_del_neighbor(msg)
+
     if action == 'RTM_DELROUTE':
         parse_del_route(msg)
 
 
-def bootstrap_routes():
-    routes = ipr.get_routes()
-    for i in routes:
-        if i['event'] == 'RTM_NEWROUTE':
-            parse_new_route(i)
+def get_attr(msg, name):
+    for att in msg['attrs']:
+        if att[0] == name:
+            return att[1]
+    return None
+
+
+def dump_neighbors():
+    # One netlink dump of the neighbor table, as {neighbor_ip: mac}
+    neighbors = {}
+    for msg in ipr.get_neighbours(family=socket.AF_INET):
+        if msg['ifindex'] not in ifnames:
+            continue
+        dst = get_attr(msg, 'NDA_DST')
+        lladdr = get_attr(msg, 'NDA_LLADDR')
+        if dst and lladdr:
+            neighbors[dst] = lladdr
+    neighbortable.clear()
+    neighbortable.update(neighbors)
+    return neighbors
+
+
+def resolve_neighbors(neighbor_ips):
+    # Probe all unresolved gateways at once, then re-read the neighbor
+    # table once instead of once per route
+    for ip in neighbor_ips:
+        send_ping(ip)
+    deadline = time.time() + RESOLVE_WAIT_S
+    while True:
+        neighbors = dump_neighbors()
+        if all(ip in neighbors for ip in neighbor_ips) or \
+                time.time() >= deadline:
+            return neighbors
+        time.sleep(0.1)
+
+
+def refresh_ifnames():
+    # {ifindex: ifname} of the controlled interfaces
+    ifnames.clear()
+    for name in args.i:
+        idx = ipr.link_lookup(ifname=name)
+        if idx:
+            ifnames[idx[0]] = name
+        else:
+            print('Interface {} not found'.format(name))
+
+
+def read_dataplane(bessd):
+    # Modules hanging off each route module, as {iface: {gate: name}}, and
+    # the members of each group, as {group module: {ogate: name}}
+    dataplane = {}
+    links = {}
+    for iface in args.i:
+        route_module = iface + 'Routes'
+        try:
+            info = bessd.server.get_module_info(route_module)
+        except BESS.Error as e:
+            print('Unable to read back {}: {}'.format(route_module, e))
+            continue
+        dataplane[iface] = {ogate.ogate: ogate.name for ogate in info.ogates
+                            if ogate.ogate < ROUTE_GATES}
+        for name in dataplane[iface].values():
+            if not name.startswith(route_module + 'ECMP'):
+                continue
+            try:
+                info = bessd.server.get_module_info(name)
+            except BESS.Error as e:
+                print('Unable to read back {}: {}'.format(name, e))
+                continue
+            links[name] = {ogate.ogate: ogate.name for ogate in info.ogates}
+    return dataplane, links
+
+
+def forget_iface(bessd, iface):
+    for key in [key for key in bessd.routecache if key[0] == iface]:
+        del bessd.routecache[key]
+    for ip in [ip for ip, n in bessd.neighborcache.items()
+               if n.iface == iface]:
+        del bessd.neighborcache[ip]
+    for key in [key for key in bessd.groupcache if key[0] == iface]:
+        del bessd.groupcache[key]
+
+
+def reconcile_dataplane(bessd, dataplane, links, neighbors):
+    # Align the neighborcache/modgates of bessd with the Update modules
+    # found in it.
+    # IPLookup entries cannot be read back, so a route module that lost all
+    # the Update modules we know about is taken to be freshly reloaded.
+    macs = {mac2hex(mac): ip for ip, mac in neighbors.items()}
+    for iface in args.i:
+        route_module = iface + 'Routes'
+        prefix = route_module + 'DstMAC'
+        gates = dataplane.get(iface, {})
+        cached = {ip: n for ip, n in bessd.neighborcache.items()
+                  if n.iface == iface}
+        live = {ip for ip, n in cached.items()
+                if gates.get(n.gate_idx) == n.module}
+
+        if cached and not live:
+            print('{} was reloaded, reprogramming its routes'.format(
+                route_module))
+            forget_iface(bessd, iface)
+        else:
+            for ip in set(cached) - live:
+                print('Update module for {} is gone, reprogramming its '
+                      'routes'.format(ip))
+                del bessd.neighborcache[ip]
+                for key in [key for key, item in bessd.routecache.items()
+                            if item.target == ip]:
+                    del bessd.routecache[key]
+
+        # A group is gone with its module or with any of its members
+        for key, group in list(bessd.groupcache.items()):
+            if group.iface != iface:
+                continue
+            members = links.get(group.module, {})
+            if gates.get(group.gate_idx) == group.module and \
+                    all(ip in bessd.neighborcache and members.get(ogate) ==
+                        bessd.neighborcache[ip].module
+                        for ip, ogate in group.members.items()):
+                continue
+            print('Group {} is gone, reprogramming its routes'.format(group))
+            del bessd.groupcache[key]
+            for ip in group.members:
+                if ip in bessd.neighborcache:
+                    bessd.neighborcache[ip].route_count -= 1
+            for route in [route for route, item in bessd.routecache.items()
+                          if item.target == key]:
+                del bessd.routecache[route]
+
+        # Adopt modules we did not create, e.g. from before a restart
+        known = {n.module for n in bessd.neighborcache.values()}
+        known.update(g.module for g in bessd.groupcache.values())
+        for gate, name in gates.items():
+            if name in known:
+                continue
+            if name.startswith(route_module + 'ECMP'):
+                # Its routes are re-added to new groups, after which the
+                # unreferenced group is destroyed
+                group = GroupEntry()
+                group.iface = iface
+                group.gate_idx = gate
+                group.module = name
+                bessd.groupcache[(iface, name)] = group
+                continue
+            if not name.startswith(prefix):
+                print('Leaving unknown module {} on {}:{}'.format(
+                    name, route_module, gate))
+                continue
+            # Names are <iface>RoutesDstMAC<mac>[G<gate>]
+            ip = macs.get(int(name[len(prefix):].split('G')[0], 16))
+            if not ip or ip in bessd.neighborcache:
+                print('Leaving unknown module {} on {}:{}'.format(
+                    name, route_module, gate))
+                continue
+            item = NeighborEntry()
+            item.neighbor_ip = ip
+            item.iface = iface
+            item.gate_idx = gate
+            item.macstr = name[len(prefix):].split('G')[0]
+            item.module = name
+            bessd.neighborcache[ip] = item
+
+        bessd.modgates[route_module] = GateAllocator(gates)
+
+
+def kernel_routes(neighbors):
+    # Routes on our interfaces as add events, the keys of all of them and
+    # how many are left waiting for their gateway to resolve
+    events = OrderedDict()
+    seen = set()
+    unresolved = []
+    pending = 0
+    for msg in ipr.get_routes(family=socket.AF_INET):
+        if msg['event'] != 'RTM_NEWROUTE':
+            continue
+        item = route_from_msg(msg)
+        if not item:
+            continue
+        seen.add(route_key(item))
+        if all(ip in neighbors for ip in gateways(item)):
+            events[route_key(item)] = route_event(item, neighbors)
+        else:
+            unresolved.append(item)
+
+    if unresolved:
+        ips = {ip for item in unresolved for ip in gateways(item)
+               if ip not in neighbors}
+        print('Resolving {} gateways for {} routes...'.format(
+            len(ips), len(unresolved)))
+        neighbors.update(resolve_neighbors(list(ips)))
+        for item in unresolved:
+            event = route_event(item, neighbors)
+            if event:
+                events[route_key(item)] = event
+            # Leave the rest to the probe scheduler and RTM_NEWNEIGH handler
+            missing = [ip for ip in gateways(item) if ip not in neighbors]
+            for ip in missing:
+                probes.add(item, probed=True, neighbor_ip=ip)
+            if missing:
+                pending += 1
+    return events, seen, pending
+
+
+def route_event(item, neighbors):
+    # Add event over the resolved gateways of a route, if it has any
+    macs = {ip: mac2hex(neighbors[ip]) for ip in gateways(item)
+            if ip in neighbors}
+    if not macs:
+        return None
+    if item.nexthops:
+        return ('add', item, macs)
+    return ('add', item, macs[item.neighbor_ip])
+
+
+def sync_kernel():
+    # Snapshot the kernel tables once for all bessd instances to sync with
+    refresh_ifnames()
+    neighbors = dump_neighbors()
+    events, seen, pending = kernel_routes(neighbors)
+    return neighbors, events, seen, pending
+
+
+def sync_bessd(bessd, kernel):
+    # Bring bessd in line with the kernel, only programming the difference
+    neighbors, events, seen, pending = kernel
+    start = time.time()
+    dataplane, links = read_dataplane(bessd)
+    reconcile_dataplane(bessd, dataplane, links, neighbors)
+
+    events = OrderedDict(events)
+    for ip, neighbor in bessd.neighborcache.items():
+        if ip in neighbors and \
+                neighbor.macstr != '{:X}'.format(mac2hex(neighbors[ip])):
+            events[('neigh', ip)] = ('mac', ip, mac2hex(neighbors[ip]))
+    for key, (action, item, gateway_mac) in list(events.items()):
+        current = bessd.routecache.get(key)
+        if action == 'add' and current and \
+                current.target == route_target(item, gateway_mac):
+            del events[key]
+    for key, item in list(bessd.routecache.items()):
+        if key not in seen:
+            events[key] = ('del', item, None)
+
+    # Program the whole delta in a single pause
+    retry = apply_route_batch(bessd, events)
+    # Also captures what reconciling with bessd changed
+    bessd.journal.sync()
+
+    elapsed = time.time() - start
+    print('Synced {} kernel routes with {} ({} programmed, {} unresolved) '
+          'in {:.3f} sec ({:.0f} routes/sec)'.format(
+              len(seen), bessd, len(bessd.routecache), pending, elapsed,
+              len(seen) / elapsed if elapsed > 0 else 0))
+    return retry
+
+
+def route_record(item):
+    rec = {'op': 'route', 'iface': item.iface, 'prefix': item.iprange,
+           'len': int(item.prefix_len), 'target': item.target}
+    if item.nexthops:
+        rec['nexthops'] = item.nexthops
+    else:
+        rec['gw'] = item.neighbor_ip
+    return rec
+
+
+def neighbor_record(neighbor):
+    return {'op': 'neigh', 'ip': neighbor.neighbor_ip,
+            'iface': neighbor.iface, 'gate': neighbor.gate_idx,
+            'mac': neighbor.macstr, 'module': neighbor.module}
+
+
+def group_record(group):
+    return {'op': 'group', 'iface': group.iface, 'nexthops': group.nexthops,
+            'gate': group.gate_idx, 'module': group.module,
+            'members': group.members}
+
+
+def hops_key(iface, nexthops):
+    # JSON turns group keys into lists, make them hashable again
+    return (iface, tuple(tuple(hop) for hop in nexthops))
+
+
+class Journal:
+    """Append-only record of the state programmed in bessd.
+
+    Every change to the routecache, neighborcache and groupcache of a bessd
+    is written as one JSON line when its batch completes, so that a restarted
+    route_control can load its state, check it against bessd and only
+    program the difference. The file is rewritten as a snapshot when a full
+    sync with the kernel leaves it out of date, and whenever superseded
+    records outnumber the live ones.
+    """
+    def __init__(self, bessd, path):
+        self.bessd = bessd
+        self.path = path
+        self.file = None
+        self.lines = []
+        # records in the file, against which compaction is decided
+        self.records = 0
+        # the file must be rewritten before anything is appended to it
+        self.stale = False
+
+    def _record(self, rec):
+        if self.path:
+            self.lines.append(json.dumps(rec, separators=(',', ':')))
 
+    def route(self, item):
+        self._record(route_record(item))
 
-def connect_bessd():
-    print('Connecting to BESS daemon...'),
-    # Connect to BESS (assuming host=localhost, port=10514 (default))
-    for i in range(MAX_RETRIES):
+    def unroute(self, item):
+        self._record({'op': 'unroute', 'iface': item.iface,
+                      'prefix': item.iprange, 'len': int(item.prefix_len)})
+
+    def neighbor(self, neighbor):
+        self._record(neighbor_record(neighbor))
+
+    def unneighbor(self, neighbor):
+        self._record({'op': 'unneigh', 'ip': neighbor.neighbor_ip})
+
+    def group(self, group):
+        self._record(group_record(group))
+
+    def ungroup(self, key):
+        # Groups adopted from bessd are keyed by name and never journaled
+        if isinstance(key[1], tuple):
+            self._record({'op': 'ungroup', 'iface': key[0],
+                          'nexthops': key[1]})
+
+    def flush(self):
+        if not self.lines:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write('\n'.join(self.lines) + '\n')
+        self.file.flush()
+        self.records += len(self.lines)
+        self.lines = []
+        if self.garbage() > max(self.records - self.garbage(),
+                                JOURNAL_COMPACT_MIN):
+            self.compact()
+
+    def garbage(self):
+        # Records not backing a live entry, or live entries not recorded
+        bessd = self.bessd
+        live = (len(bessd.routecache) + len(bessd.neighborcache) +
+                len(bessd.groupcache))
+        return self.records - 1 - live
+
+    def sync(self):
+        # After a full sync, only rewrite the file if it is out of date
+        if self.path and (self.stale or self.garbage() != 0):
+            self.compact()
+
+    def compact(self):
+        if not self.path:
+            return
+        start = time.time()
+        self.lines = []
+        records = [{'op': 'version', 'version': JOURNAL_VERSION}]
+        bessd = self.bessd
+        records += [neighbor_record(n) for n in bessd.neighborcache.values()]
+        records += [group_record(g) for g in bessd.groupcache.values()
+                    if isinstance(g.nexthops, tuple) and g.nexthops]
+        records += [route_record(item) for item in bessd.routecache.values()]
+        # Write aside and rename, so a crash leaves either file intact
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for rec in records:
+                f.write(json.dumps(rec, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.records = len(records)
+        self.stale = False
+        print('Compacted state journal {} to {} records in {:.3f} sec'.format(
+            self.path, len(records), time.time() - start))
+
+    def load(self):
+        # Fill the routecache, neighborcache and groupcache of bessd from the
+        # journal
+        if not self.path or not os.path.exists(self.path):
+            return
+        neighbors = {}
+        groups = {}
+        routes = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # The last write was cut short, keep what came before
+                    print('Ignoring truncated record in {}'.format(self.path))
+                    self.stale = True
+                    break
+                op = rec['op']
+                if op == 'version' and rec['version'] != JOURNAL_VERSION:
+                    print('Ignoring {} written by another version'.format(
+                        self.path))
+                    self.stale = True
+                    return
+                elif op == 'neigh':
+                    neighbor = NeighborEntry()
+                    neighbor.neighbor_ip = rec['ip']
+                    neighbor.iface = rec['iface']
+                    neighbor.gate_idx = rec['gate']
+                    neighbor.macstr = rec['mac']
+                    neighbor.module = rec['module']
+                    neighbors[rec['ip']] = neighbor
+                elif op == 'unneigh':
+                    neighbors.pop(rec['ip'], None)
+                elif op == 'group':
+                    group = GroupEntry()
+                    group.iface = rec['iface']
+                    group.nexthops = hops_key(rec['iface'],
+                                              rec['nexthops'])[1]
+                    group.gate_idx = rec['gate']
+                    group.module = rec['module']
+                    group.members = rec['members']
+                    groups[(group.iface, group.nexthops)] = group
+                elif op == 'ungroup':
+                    groups.pop(hops_key(rec['iface'], rec['nexthops']), None)
+                elif op == 'route':
+                    item = NeighborEntry()
+                    item.iface = rec['iface']
+                    item.iprange = rec['prefix']
+                    item.prefix_len = rec['len']
+                    item.neighbor_ip = rec.get('gw')
+                    if 'nexthops' in rec:
+                        item.nexthops = hops_key(item.iface,
+                                                 rec['nexthops'])[1]
+                    item.target = rec['target']
+                    if isinstance(item.target, list):
+                        item.target = hops_key(*item.target)
+                    routes[route_key(item)] = item
+                elif op == 'unroute':
+                    routes.pop((rec['iface'], rec['prefix'], rec['len']),
+                               None)
+                self.records += 1
+
+        # Refcounts are derived, and entries left dangling are dropped
+        for key, group in list(groups.items()):
+            if all(ip in neighbors for ip in group.members):
+                for ip in group.members:
+                    neighbors[ip].route_count += 1
+            else:
+                del groups[key]
+        for key, item in list(routes.items()):
+            nexthop = (groups if is_group(item.target) else neighbors).get(
+                item.target)
+            if nexthop:
+                nexthop.route_count += 1
+            else:
+                del routes[key]
+
+        self.bessd.neighborcache.update(neighbors)
+        self.bessd.groupcache.update(groups)
+        self.bessd.routecache.update(routes)
+        print('Loaded {} routes, {} neighbors and {} groups from {}'.format(
+            len(routes), len(neighbors), len(groups), self.path))
+
+
+class Bessd:
+    """A bessd instance programmed with the routes of the kernel.
+
+    Kernel state is tracked once by the controller, while each instance
+    keeps what is programmed in it, its own batch of events still to apply,
+    retry timers and health, and a worker thread of its own. A slow or
+    unreachable bessd thus never holds up the others.
+    """
+    def __init__(self, url, server, state_file, window_s, max_events):
+        self.url = url
+        self.server = server
+        # for holding list of registered neighbors
+        self.neighborcache = {}
+        # for holding ECMP groups, keyed by (iface, nexthops)
+        self.groupcache = {}
+        # for allocating gates per route module
+        self.modgates = {}
+        # for holding programmed routes, keyed by (iface, prefix, prefix_len)
+        self.routecache = {}
+        # for pause and batch accounting
+        self.stats = {'pauses': 0, 'paused_s': 0.0, 'batches': 0,
+                      'batch_events': 0, 'max_batch': 0}
+        # for exporting counters and histograms
+        self.metrics = Metrics()
+        # for persisting programmed state across restarts
+        self.journal = Journal(self, state_file)
+        # events handed over by the controller, and those to retry
+        self.batch = RouteBatch(window_s, max_events)
+        self.retries = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.healthy = True
+        self.busy = False
+        # kernel snapshot to sync with, and a counter of syncs so that
+        # retries of batches applied before one are dropped
+        self.kernel = None
+        self.epoch = 0
+        self.wakeup = None
+
+    def __str__(self):
+        return self.url
+
+    def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def resync(self, kernel):
+        # Whatever was pending predates the snapshot
+        self.batch.clear()
+        self.retries = []
+        self.kernel = kernel
+        self.epoch += 1
+        self.wakeup.set()
+
+    def requeue_due(self):
+        now = time.time()
+        due = [r for r in self.retries if r[0] <= now]
+        self.retries = [r for r in self.retries if r[0] > now]
+        for _, retry, stamps in due:
+            self.batch.requeue(retry, stamps)
+
+    def timeout(self):
+        if not self.healthy:
+            # connect_bessd() itself waits SLEEP_S after a failed attempt
+            return 0
+        if not self.retries:
+            return None
+        return max(min(r[0] for r in self.retries) - time.time(), 0)
+
+    def idle(self):
+        return not (self.busy or self.batch.pending or self.retries or
+                    self.kernel)
+
+
+def connect_bessd(bessd, attempts=MAX_RETRIES):
+    print('Connecting to BESS daemon at {}...'.format(bessd)),
+    for i in range(attempts):
         try:
-            if not bess.is_connected():
-                bess.connect(grpc_url=args.ip + ':' + args.port)
+            if not bessd.server.is_connected():
+                bessd.server.connect(grpc_url=bessd.url)
         except BESS.RPCError:
             print(
                 'Error connecting to BESS daemon. Retrying in {}sec...'.format(
@@ -435,65 +1677,347 @@ def connect_bessd():
         else:
             break
     else:
-        raise Exception('BESS connection failure.')
+        return False
 
     print('Done.')
+    return True
+
+
+def reconfigure():
+    print('Reloading routes')
+    # Unresolved gateways are collected again from the kernel
+    probes.clear()
+    # The kernel table is the source of truth again
+    batch.clear()
+    return sync_kernel()
+
+
+class RouteController:
+    """Asyncio front end of route_control.
+
+    A reader task drains the netlink socket into a bounded queue, and a
+    single consumer task parses events, coalesces them and reloads routes.
+    Kernel side blocking calls (netlink dumps and probes) run on one worker
+    thread. Each batch is handed over to every healthy bessd, which a task
+    of its own programs from its worker thread, so state mutations stay
+    serialized per bessd. Transient RPC failures are requeued with a timer
+    instead of sleeping.
+    """
+    def __init__(self, window_s, max_events, metrics_port=0):
+        self.batch = RouteBatch(window_s, max_events)
+        self.metrics_port = metrics_port
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.reload = False
+        # bessd instances back from an outage, to sync with the kernel
+        self.resyncs = set()
+        self.stopping = False
+        self.loop = None
+        self.queue = None
+
+    def call(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def wake(self):
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            # The consumer is busy and will notice on its next iteration
+            pass
+
+    def on_reload(self):
+        print('Received: SIGHUP Reloading routes')
+        self.reload = True
+        self.wake()
+
+    def on_exit(self, signame):
+        print('Received: {} Exiting'.format(signame))
+        self.stopping = True
+        self.wake()
+
+    async def read_events(self):
+        readable = asyncio.Event()
+        fd = nl.fileno()
+        self.loop.add_reader(fd, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                # The reader callback may fire again for data that was
+                # already drained, and get() would then block the loop
+                if not select.select([fd], [], [], 0)[0]:
+                    continue
+                try:
+                    msgs = nl.get()
+                except OSError as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # The kernel dropped events, resync from a fresh dump
+                    print('Netlink socket overrun, reloading routes')
+                    self.reload = True
+                    continue
+                now = time.time()
+                for msg in msgs:
+                    await self.queue.put((now, msg))
+        finally:
+            self.loop.remove_reader(fd)
+
+    def handle_events(self, events):
+        for stamp, msg in events:
+            self.batch.stamp = stamp
+            netlink_event_listener(msg, msg['event'])
+        self.batch.stamp = None
+
+    def timeout(self):
+        timeouts = [t for t in [self.batch.timeout(), probes.timeout()]
+                    if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def schedule_retry(self, bessd, retry, stamps):
+        if retry:
+            bessd.metrics.requeued += len(retry)
+            bessd.retries.append((time.time() + SLEEP_S, retry, stamps))
+
+    async def resync(self):
+        # One kernel dump serves every bessd that needs a full sync
+        if self.reload:
+            targets = bessds
+            snapshot = reconfigure
+        else:
+            targets = list(self.resyncs)
+            snapshot = sync_kernel
+        self.reload = False
+        self.resyncs.clear()
+        kernel = await self.call(snapshot)
+        for bessd in targets:
+            if bessd.healthy:
+                bessd.resync(kernel)
+
+    def flush(self):
+        # Hand the batch over to every bessd that is up, those that are not
+        # resync once they are back
+        events, stamps = self.batch.take()
+        for bessd in bessds:
+            if bessd.healthy:
+                bessd.batch.merge(events, stamps)
+                bessd.wakeup.set()
+
+    def applied(self, bessd, latencies):
+        # Event-to-dataplane latency of each event applied by a batch
+        if latencies:
+            print('Event-to-dataplane latency on {}: avg {:.1f} ms, '
+                  'max {:.1f} ms'.format(
+                      bessd, sum(latencies) / len(latencies) * 1000,
+                      max(latencies) * 1000))
+
+    def lost(self, bessd):
+        print('Lost connection to {}, resyncing once it is back'.format(bessd))
+        bessd.healthy = False
+        bessd.batch.clear()
+        bessd.retries = []
+        bessd.kernel = None
+
+    async def program(self, bessd):
+        # Apply whatever is pending for one bessd, and retry what failed.
+        # A resync requested meanwhile supersedes the failed events.
+        retry = None
+        epoch = bessd.epoch
+        if bessd.kernel:
+            kernel, bessd.kernel = bessd.kernel, None
+            retry = await bessd.call(sync_bessd, bessd, kernel)
+            if bessd.epoch == epoch:
+                self.schedule_retry(bessd, retry, {})
+        bessd.requeue_due()
+        if bessd.batch.pending:
+            events, stamps = bessd.batch.take()
+            retry = await bessd.call(apply_route_batch, bessd, events)
+            now = time.time()
+            latencies = [now - stamps[key] for key in events
+                         if key not in retry]
+            for latency in latencies:
+                bessd.metrics.programmed.observe(latency)
+            self.applied(bessd, latencies)
+            if bessd.epoch == epoch:
+                self.schedule_retry(bessd, retry, stamps)
+        if retry and not bessd.server.is_connected():
+            self.lost(bessd)
+
+    async def run_bessd(self, bessd):
+        while True:
+            try:
+                await asyncio.wait_for(bessd.wakeup.wait(), bessd.timeout())
+            except asyncio.TimeoutError:
+                pass
+            bessd.wakeup.clear()
+            bessd.busy = True
+            try:
+                if bessd.healthy:
+                    await self.program(bessd)
+                elif await bessd.call(connect_bessd, bessd, 1):
+                    bessd.healthy = True
+                    self.resyncs.add(bessd)
+                    self.wake()
+            except BESS.RPCError as e:
+                # e.g. pause_all on a dead connection, outside of rpc()
+                print('Error programming {}: {}'.format(bessd, e))
+                self.lost(bessd)
+            finally:
+                bessd.busy = False
+
+    def on_done(self, task):
+        # Anything else a bessd task raises stops the controller
+        if not task.cancelled() and task.exception():
+            self.stopping = True
+            self.wake()
+
+    async def process_events(self):
+        while not self.stopping:
+            events = []
+            try:
+                event = await asyncio.wait_for(self.queue.get(),
+                                               self.timeout())
+            except asyncio.TimeoutError:
+                event = None
+            # Drain whatever else is already queued
+            while True:
+                if event is not None:
+                    events.append(event)
+                if len(events) >= self.batch.max_events or \
+                        self.queue.empty():
+                    break
+                event = self.queue.get_nowait()
 
+            if events:
+                await self.call(self.handle_events, events)
 
-def reconfigure(number, frame):
-    print('Received: {} Reloading routes'.format(number))
-    # clear arpcache
-    for ip in list(arpcache):
-        item = arpcache.get(ip)
-        del item
-    arpcache.clear()
-    for ip in list(neighborcache):
-        item = neighborcache.get(ip)
-        del item
-    neighborcache.clear()
-    for modname in list(modgatecnt):
-        item = modgatecnt.get(modname)
-        del item
-    modgatecnt.clear()
-    bootstrap_routes()
-    signal.pause()
-
+            if self.reload or self.resyncs:
+                await self.resync()
 
-def cleanup(number, frame):
-    ipdb.unregister_callback(event_callback)
-    print('Received: {} Exiting'.format(number))
-    sys.exit()
+            if probes.timeout() == 0:
+                await self.call(probes.tick)
 
+            if self.batch.ready(self.queue.empty()):
+                self.flush()
 
-def main():
-    global arpcache, neighborcache, modgatecnt, ipdb, event_callback, bess, ipr
-    # for holding unresolved ARP queries
-    arpcache = {}
-    # for holding list of registered neighbors
-    neighborcache = {}
-    # for holding gate count per route module
-    modgatecnt = {}
+    async def serve_metrics(self, reader, writer):
+        # Minimal HTTP/1.0 responder, scrapes are rendered on the loop
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            if request.split()[1:2] == [b'/metrics']:
+                status, body = '200 OK', render_metrics().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; '
+                         'version=0.0.4\r\nContent-Length: {}\r\n\r\n'
+                         .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.loop.add_signal_handler(signal.SIGHUP, self.on_reload)
+        self.loop.add_signal_handler(signal.SIGINT, self.on_exit, 'SIGINT')
+        self.loop.add_signal_handler(signal.SIGTERM, self.on_exit, 'SIGTERM')
+
+        server = None
+        if self.metrics_port:
+            server = await asyncio.start_server(self.serve_metrics,
+                                                port=self.metrics_port)
+            print('Serving metrics on port {}'.format(self.metrics_port))
+
+        # listen for netlink events while the current routes are programmed
+        reader = asyncio.ensure_future(self.read_events())
+        kernel = await self.call(sync_kernel)
+        for bessd in bessds:
+            bessd.wakeup = asyncio.Event()
+            if bessd.healthy:
+                bessd.resync(kernel)
+        tasks = [asyncio.ensure_future(self.run_bessd(bessd))
+                 for bessd in bessds]
+        for task in tasks:
+            task.add_done_callback(self.on_done)
+        try:
+            await self.process_events()
+        finally:
+            reader.cancel()
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            if server:
+                server.close()
+            self.executor.shutdown()
+            for bessd in bessds:
+                bessd.executor.shutdown()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+
+def setup_state(kernel, servers, probe_sock=None):
+    global probes, neighbortable, netlink_events
+    global ifnames, bessds, ipr, batch
+    # for probing unresolved gateways
+    probes = ProbeScheduler(args.probe_rate, args.probe_timeout, probe_sock)
+    # for holding the kernel neighbor table, as {neighbor_ip: mac}
+    neighbortable = {}
+    # for counting netlink events by type
+    netlink_events = Counter()
     # for interacting with kernel
-    ipdb = IPDB()
-    ipr = IPRoute()
-    # for bess client
-    bess = BESS()
+    ipr = kernel
+    # for mapping ifindex to the controlled interfaces
+    ifnames = {}
+
+    controller = RouteController(args.batch_window_ms / 1000.0,
+                                 args.batch_size, args.metrics_port)
+    batch = controller.batch
+    # for bess clients, each journaling to a file of its own
+    bessds = []
+    for url, server in servers.items():
+        state_file = args.state_file
+        if state_file and len(servers) > 1:
+            state_file += '.' + url.replace(':', '_')
+        bessds.append(Bessd(url, server, state_file, controller.batch.window_s,
+                            args.batch_size))
+    return controller
 
-    # connect to bessd
-    connect_bessd()
 
-    # program current routes
-    bootstrap_routes()
-
-    # listen for netlink events
-    print('Registering netlink event listener callback...'),
-    event_callback = ipdb.register_callback(netlink_event_listener)
-    print('Done.')
+def main():
+    global nl
+    # for receiving route and neighbor events only
+    nl = IPRoute()
+    nl.bind(groups=RTMGRP_IPV4_ROUTE | RTMGRP_NEIGH)
+    urls = args.bessd or [args.ip + ':' + args.port]
+    controller = setup_state(IPRoute(),
+                             OrderedDict((url, BESS()) for url in urls))
+    for bessd in bessds:
+        # pick up what a previous instance programmed, checked at bootstrap
+        bessd.journal.load()
+        # connect to bessd, those that are down are synced once they are up
+        bessd.healthy = connect_bessd(bessd)
+    if not any(bessd.healthy for bessd in bessds):
+        raise Exception('BESS connection failure.')
 
-    signal.signal(signal.SIGHUP, reconfigure)
-    signal.signal(signal.SIGINT, cleanup)
-    signal.signal(signal.SIGTERM, cleanup)
-    signal.pause()
+    # let up4.bess find us without scanning every process on reload
+    if args.pid_file:
+        with open(args.pid_file, 'w') as f:
+            f.write('{}\n'.format(os.getpid()))
+
+    # program current routes and listen for netlink events
+    try:
+        asyncio.run(controller.run())
+    finally:
+        nl.close()
+        ipr.close()
+        if args.pid_file:
+            try:
+                os.unlink(args.pid_file)
+            except OSError:
+                pass
 
 
 if __name__ == '__main__':
@@ -508,6 +2032,46 @@ if __name__ == '__main__':
                         default='localhost',
                         help='BESSD address')
     parser.add_argument('--port', type=str, default='10514', help='BESSD port')
+    parser.add_argument('--bessd',
+                        type=str,
+                        nargs='+',
+                        metavar='HOST:PORT',
+                        help='program each of these BESSD instances '
+                        '(overrides --ip and --port)')
+    parser.add_argument('--batch-window-ms',
+                        type=int,
+                        default=0,
+                        help='coalesce route events for this many ms and '
+                        'apply them under a single pause (0 applies them as '
+                        'soon as pending netlink events are drained)')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1024,
+                        help='flush a batch early once it holds this many '
+                        'route events')
+    parser.add_argument('--probe-rate',
+                        type=int,
+                        default=100,
+                        help='maximum gateway probes sent per second')
+    parser.add_argument('--probe-timeout',
+                        type=int,
+                        default=60,
+                        help='seconds to keep probing an unresolved gateway')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=0,
+                        help='serve Prometheus metrics on this port '
+                        '(0 disables)')
+    parser.add_argument('--state-file',
+                        type=str,
+                        default='',
+                        help='journal programmed state to this file, and '
+                        'reconcile from it on restart')
+    parser.add_argument('--pid-file',
+                        type=str,
+                        default='/tmp/route_control.pid',
+                        help='write our pid to this file for up4.bess to '
+                        'signal on reload (empty disables)')
 
     # for holding command-line arguments
     global args
@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2022-present Open Networking Foundation
+
+"""Offline replay benchmark for route_control.py.
+
+Netlink route/neighbor messages are fed through route_control's event
+controller exactly as they would arrive from the kernel, while bessd is
+replaced by an in-process stub implementing the pybess calls route_control
+makes. No kernel routes, privileges or bessd are needed.
+
+Synthetic scenarios:
+  burst     add --routes routes over --gateways resolved gateways, then
+            delete them all
+  resolve   add routes over unresolved gateways, then resolve the gateways
+  flap      add and delete the same routes --flaps times
+  failover  add routes, then move every gateway to a new MAC
+  noise     burst interleaved with neighbor churn on an interface that is
+            not controlled
+  ecmp      add multipath routes over all gateways, withdraw one path from
+            every route, then restore it
+
+A stream captured with --record can be replayed with --replay.
+
+--startup RUNS measures, over fresh interpreters, how long route_control
+takes from process start to programming its first route.
+
+--restart measures how long a restarted route_control takes to converge
+on the replayed state, with and without its state journal.
+
+--targets N programs N stub bessd instances at once, each with the RPC
+latency given for it by --rpc-latency-us, and reports latency per target.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import errno
+import json
+import os
+import select
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+
+STARTED = time.time()
+import route_control as rc
+IMPORTED = time.time()
+
+CORE_IFINDEX = 2
+FOREIGN_IFINDEX = 99
+
+
+class StubBESS:
+    """In-memory stand-in for the pybess calls made by route_control."""
+    def __init__(self, ifaces, rpc_latency_s=0):
+        self.rpc_latency_s = rpc_latency_s
+        # module name -> {ogate: next module}
+        self.modules = {}
+        # route module -> {(prefix, prefix_len): gate}
+        self.tables = {}
+        self.rpcs = Counter()
+        self.pauses = 0
+        self.paused_s = 0.0
+        self.paused_at = None
+        for iface in ifaces:
+            self.modules[iface + 'Routes'] = {}
+            self.modules[iface + 'Merge'] = {}
+            self.tables[iface + 'Routes'] = {}
+
+    def _rpc(self, name):
+        self.rpcs[name] += 1
+        if self.rpc_latency_s:
+            time.sleep(self.rpc_latency_s)
+
+    def _error(self, code, msg):
+        return rc.BESS.Error(code, msg, None)
+
+    def is_connected(self):
+        return True
+
+    def pause_all(self):
+        self._rpc('pause_all')
+        self.paused_at = time.time()
+
+    def resume_all(self):
+        self._rpc('resume_all')
+        self.pauses += 1
+        self.paused_s += time.time() - self.paused_at
+
+    def run_module_command(self, name, cmd, arg_type, arg):
+        self._rpc('{}.{}'.format(arg_type, cmd))
+        if name not in self.modules:
+            raise self._error(errno.ENOENT, 'No module {}'.format(name))
+        table = self.tables.get(name)
+        if table is None:
+            return
+        key = (arg.get('prefix'), arg.get('prefix_len'))
+        if cmd == 'add':
+            table[key] = arg['gate']
+        elif cmd == 'delete':
+            if key not in table:
+                raise self._error(errno.ENOENT, 'No route {}/{}'.format(*key))
+            del table[key]
+
+    def create_module(self, mclass, name, arg):
+        self._rpc('create_module')
+        if name in self.modules:
+            raise self._error(errno.EEXIST, 'Module {} exists'.format(name))
+        self.modules[name] = {}
+
+    def connect_modules(self, m1, m2, ogate=0, igate=0):
+        self._rpc('connect_modules')
+        ogates = self.modules[m1]
+        if ogate in ogates:
+            raise self._error(errno.EBUSY, 'Gate {} in use'.format(ogate))
+        ogates[ogate] = m2
+
+    def disconnect_modules(self, name, ogate=0):
+        self._rpc('disconnect_modules')
+        if self.modules[name].pop(ogate, None) is None:
+            raise self._error(errno.ENOENT, 'Gate {} not connected'.format(
+                ogate))
+
+    def destroy_module(self, name):
+        self._rpc('destroy_module')
+        del self.modules[name]
+        for ogates in self.modules.values():
+            for gate in [g for g, m in ogates.items() if m == name]:
+                del ogates[gate]
+
+    def get_module_info(self, name):
+        self._rpc('get_module_info')
+        if name not in self.modules:
+            raise self._error(errno.ENOENT, 'No module {}'.format(name))
+        return SimpleNamespace(ogates=[
+            SimpleNamespace(ogate=gate, name=module)
+            for gate, module in self.modules[name].items()])
+
+
+class StubKernel:
+    """Answers the netlink dumps route_control makes on (re)load."""
+    def __init__(self, ifnames, routes=(), neighbors=()):
+        self.ifindexes = {name: idx for idx, name in ifnames.items()}
+        self.routes = list(routes)
+        self.neighbors = list(neighbors)
+
+    def link_lookup(self, ifname):
+        return [self.ifindexes[ifname]] if ifname in self.ifindexes else []
+
+    def get_routes(self, family=None):
+        return list(self.routes)
+
+    def get_neighbours(self, family=None):
+        return list(self.neighbors)
+
+    def close(self):
+        pass
+
+
+class NullSocket:
+    def sendto(self, data, addr):
+        return len(data)
+
+
+def route_msg(event, prefix, prefix_len, gateway, ifindex=CORE_IFINDEX):
+    return {'event': event, 'family': 2, 'dst_len': prefix_len,
+            'attrs': [['RTA_DST', prefix], ['RTA_GATEWAY', gateway],
+                      ['RTA_OIF', ifindex]]}
+
+
+def multipath_msg(event, prefix, prefix_len, hops, ifindex=CORE_IFINDEX):
+    return {'event': event, 'family': 2, 'dst_len': prefix_len,
+            'attrs': [['RTA_DST', prefix],
+                      ['RTA_MULTIPATH', [
+                          {'oif': ifindex, 'hops': weight - 1, 'flags': 0,
+                           'attrs': [['RTA_GATEWAY', gw]]}
+                          for gw, weight in hops]]]}
+
+
+def neigh_msg(event, ip, mac, ifindex=CORE_IFINDEX):
+    return {'event': event, 'family': 2, 'ifindex': ifindex,
+            'attrs': [['NDA_DST', ip], ['NDA_LLADDR', mac]]}
+
+
+def prefix(n):
+    return '10.{}.{}.0'.format(n // 256 % 256, n % 256)
+
+
+def gateway(n):
+    return '192.168.{}.{}'.format(n // 250, n % 250 + 1)
+
+
+def mac(n, generation=0):
+    return '02:00:{:02x}:00:{:02x}:{:02x}'.format(generation, n // 256,
+                                                  n % 256)
+
+
+def synthetic(scenario, routes, gateways, flaps):
+    """Returns (initial neighbor dump, message stream) for a scenario."""
+    neighbors = [neigh_msg('RTM_NEWNEIGH', gateway(g), mac(g))
+                 for g in range(gateways)]
+    adds = [route_msg('RTM_NEWROUTE', prefix(n), 24, gateway(n % gateways))
+            for n in range(routes)]
+    dels = [route_msg('RTM_DELROUTE', prefix(n), 24, gateway(n % gateways))
+            for n in range(routes)]
+
+    if scenario == 'burst':
+        return neighbors, adds + dels
+    if scenario == 'resolve':
+        return [], adds + neighbors
+    if scenario == 'flap':
+        return neighbors, (adds + dels) * flaps
+    if scenario == 'failover':
+        return neighbors, adds + [
+            neigh_msg('RTM_NEWNEIGH', gateway(g), mac(g, 1))
+            for g in range(gateways)]
+    if scenario == 'ecmp':
+        hops = [(gateway(g), g % 2 + 1) for g in range(gateways)]
+        return neighbors, [
+            multipath_msg('RTM_NEWROUTE', prefix(n), 24, paths)
+            for paths in (hops, hops[1:], hops)
+            for n in range(routes)]
+    if scenario == 'noise':
+        stream = []
+        for n, msg in enumerate(adds + dels):
+            stream.append(msg)
+            stream.append(neigh_msg('RTM_NEWNEIGH', '172.16.0.{}'.format(
+                n % 250 + 1), mac(n % 250, 2), FOREIGN_IFINDEX))
+        return neighbors, stream
+    raise ValueError('Unknown scenario {}'.format(scenario))
+
+
+def to_json(msg):
+    attrs = []
+    for att in msg['attrs']:
+        if att[0] == 'RTA_MULTIPATH':
+            attrs.append([att[0], [{'oif': nh['oif'],
+                                    'hops': nh['hops'],
+                                    'flags': nh['flags'],
+                                    'attrs': to_json(nh)['attrs']}
+                                   for nh in att[1]]])
+        elif isinstance(att[1], (str, int)):
+            attrs.append([att[0], att[1]])
+    return {'event': msg.get('event'),
+            'family': msg.get('family'),
+            'dst_len': msg.get('dst_len'),
+            'ifindex': msg.get('ifindex'),
+            'attrs': attrs}
+
+
+def record(path, ifaces, seconds):
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE, RTMGRP_NEIGH
+
+    nl = IPRoute()
+    nl.bind(groups=RTMGRP_IPV4_ROUTE | RTMGRP_NEIGH)
+    ifnames = {}
+    for name in ifaces:
+        for idx in nl.link_lookup(ifname=name):
+            ifnames[idx] = name
+    count = 0
+    end = time.time() + seconds
+    with open(path, 'w') as f:
+        f.write(json.dumps({'ifnames': ifnames}) + '\n')
+        while time.time() < end:
+            if not select.select([nl], [], [], end - time.time())[0]:
+                continue
+            for msg in nl.get():
+                f.write(json.dumps(to_json(msg)) + '\n')
+                count += 1
+    nl.close()
+    print('Recorded {} messages to {}'.format(count, path))
+
+
+def load(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        ifnames = {int(idx): name for idx, name in header['ifnames'].items()}
+        return ifnames, [json.loads(line) for line in f]
+
+
+class ReplayController(rc.RouteController):
+    """Feeds a message stream instead of reading the netlink socket."""
+    def __init__(self, stream, rate, window_s, max_events):
+        super().__init__(window_s, max_events)
+        self.stream = stream
+        self.rate = rate
+        self.handled = 0
+        # {bessd url: [event-to-dataplane latencies]}
+        self.latencies = {}
+        self.started = None
+        self.converged = None
+        self.first_programmed = None
+
+    async def read_events(self):
+        self.started = time.time()
+        for n, msg in enumerate(self.stream):
+            if self.rate:
+                delay = self.started + n / self.rate - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.queue.put((time.time(), msg))
+        while self.handled < len(self.stream) or self.batch.pending or \
+                not all(bessd.idle() for bessd in rc.bessds):
+            await asyncio.sleep(0.001)
+        self.converged = time.time()
+        self.stopping = True
+        self.wake()
+
+    def handle_events(self, events):
+        super().handle_events(events)
+        self.handled += len(events)
+
+    def applied(self, bessd, latencies):
+        if latencies and self.first_programmed is None:
+            self.first_programmed = time.time()
+        self.latencies.setdefault(bessd.url, []).extend(latencies)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def report(controller, servers, stream):
+    elapsed = controller.converged - controller.started
+    print('events:             {}'.format(len(stream)))
+    print('converged in:       {:.3f} sec'.format(elapsed))
+    print('events/sec:         {:.0f}'.format(
+        len(stream) / elapsed if elapsed > 0 else 0))
+    print('unresolved:         {}'.format(rc.probes))
+    if controller.first_programmed:
+        print('startup:            import {:.0f} ms, first route {:.0f} ms'
+              .format((IMPORTED - STARTED) * 1000,
+                      (controller.first_programmed - STARTED) * 1000))
+    for bessd in rc.bessds:
+        server = servers[bessd.url]
+        latencies = sorted(controller.latencies.get(bessd.url, []))
+        if len(rc.bessds) > 1:
+            print('{}:'.format(bessd))
+        print('batches:            {}'.format(bessd.stats['batches']))
+        print('pauses:             {}'.format(server.pauses))
+        print('total paused:       {:.1f} ms'.format(server.paused_s * 1000))
+        print('routes programmed:  {}'.format(len(bessd.routecache)))
+        print('update modules:     {}'.format(len(bessd.neighborcache)))
+        print('latency (ms):       p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, '
+              'max {:.2f}'.format(*[percentile(latencies, pct) * 1000
+                                    for pct in (50, 90, 99, 100)]))
+        print('RPCs:')
+        for name, count in sorted(server.rpcs.items()):
+            print('  {:<36} {}'.format(name, count))
+
+
+def restart(ifnames, bessd, state_file):
+    # Restart route_control on the final state of the replay, once from
+    # its journal and once from scratch, against the same bessd
+    ifindexes = {name: idx for idx, name in ifnames.items()}
+    routes = []
+    for item in bessd.routecache.values():
+        if item.nexthops:
+            routes.append(multipath_msg('RTM_NEWROUTE', item.iprange,
+                                        item.prefix_len, item.nexthops,
+                                        ifindexes[item.iface]))
+        else:
+            routes.append(route_msg('RTM_NEWROUTE', item.iprange,
+                                    item.prefix_len, item.neighbor_ip,
+                                    ifindexes[item.iface]))
+    neighbors = [neigh_msg('RTM_NEWNEIGH', ip, lladdr,
+                           ifindexes[bessd.neighborcache[ip].iface])
+                 for ip, lladdr in rc.neighbortable.items()
+                 if ip in bessd.neighborcache]
+    kernel = StubKernel(ifnames, routes, neighbors)
+    server = bessd.server
+
+    for journaled in (True, False):
+        rc.args.state_file = state_file if journaled else ''
+        rc.setup_state(kernel, {bessd.url: server}, NullSocket())
+        server.rpcs.clear()
+        start = time.time()
+        rc.bessds[0].journal.load()
+        rc.sync_bessd(rc.bessds[0], rc.sync_kernel())
+        elapsed = time.time() - start
+        yield journaled, elapsed, sum(server.rpcs.values())
+
+
+def startup(runs):
+    # Wall clock from spawning route_control to its first programmed route
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                              '--routes', '1', '--first-route-at'],
+                             stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout
+        times.append(float(out.split()[-1]) - start)
+    print('first route programmed after start over {} runs: min {:.0f} ms, '
+          'median {:.0f} ms, max {:.0f} ms'.format(
+              runs, min(times) * 1000, statistics.median(times) * 1000,
+              max(times) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay netlink streams into route_control against a '
+        'stub bessd')
+    parser.add_argument('--scenario',
+                        choices=['burst', 'resolve', 'flap', 'failover',
+                                 'noise', 'ecmp'],
+                        default='burst',
+                        help='synthetic stream to replay')
+    parser.add_argument('--routes', type=int, default=10000,
+                        help='routes in the synthetic stream')
+    parser.add_argument('--gateways', type=int, default=4,
+                        help='gateways the routes are spread over')
+    parser.add_argument('--flaps', type=int, default=5,
+                        help='add/delete rounds for the flap scenario')
+    parser.add_argument('--replay', type=str,
+                        help='replay a stream captured with --record')
+    parser.add_argument('--record', type=str,
+                        help='capture route/neighbor events to this file')
+    parser.add_argument('--seconds', type=int, default=60,
+                        help='how long to record for')
+    parser.add_argument('-i', type=str, nargs='+', default=['core'],
+                        help='interface(s) to record or control')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='events/sec to feed (0 feeds as fast as possible)')
+    parser.add_argument('--rpc-latency-us', type=int, nargs='+', default=[0],
+                        help='simulated latency of every bessd RPC, per '
+                        'target (the last one applies to the rest)')
+    parser.add_argument('--targets', type=int, default=1,
+                        help='number of stub bessd instances to program')
+    parser.add_argument('--batch-window-ms', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--state-file', type=str, default='',
+                        help='journal state to this file')
+    parser.add_argument('--restart', action='store_true',
+                        help='measure restart convergence after the replay')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='measure startup time over this many processes')
+    parser.add_argument('--first-route-at', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true',
+                        help='show route_control output')
+    args = parser.parse_args()
+
+    if args.startup:
+        startup(args.startup)
+        return
+
+    if args.record:
+        record(args.record, args.i, args.seconds)
+        return
+
+    if args.replay:
+        ifnames, stream = load(args.replay)
+        neighbors = []
+    else:
+        ifnames = {CORE_IFINDEX: 'core'}
+        neighbors, stream = synthetic(args.scenario, args.routes,
+                                      args.gateways, args.flaps)
+
+    rc.args = argparse.Namespace(i=list(ifnames.values()),
+                                 batch_window_ms=args.batch_window_ms,
+                                 batch_size=args.batch_size,
+                                 probe_rate=100,
+                                 probe_timeout=60,
+                                 metrics_port=0,
+                                 state_file=args.state_file)
+    servers = OrderedDict()
+    for n in range(args.targets):
+        latency_us = args.rpc_latency_us[min(n,
+                                             len(args.rpc_latency_us) - 1)]
+        servers['stub{}'.format(n)] = StubBESS(rc.args.i, latency_us / 1e6)
+    controller = ReplayController(stream, args.rate,
+                                  args.batch_window_ms / 1000.0,
+                                  args.batch_size)
+    rc.setup_state(StubKernel(ifnames, neighbors=neighbors), servers,
+                   NullSocket())
+    # setup_state() creates its own controller, replay through ours
+    rc.batch = controller.batch
+
+    out = sys.stdout if args.verbose else open(os.devnull, 'w')
+    with contextlib.redirect_stdout(out):
+        asyncio.run(controller.run())
+    if args.first_route_at:
+        print(controller.first_programmed)
+        return
+    report(controller, servers, stream)
+
+    if args.restart:
+        bessd = rc.bessds[0]
+        state_file = bessd.journal.path
+        if not state_file:
+            # Journal the replay after the fact to restart from it
+            state_file = tempfile.mkstemp(prefix='route_control')[1]
+            bessd.journal = rc.Journal(bessd, state_file)
+            with contextlib.redirect_stdout(out):
+                bessd.journal.compact()
+        with contextlib.redirect_stdout(out):
+            results = list(restart(ifnames, bessd, state_file))
+        for journaled, elapsed, rpcs in results:
+            print('restart {:<11} {:.1f} ms, {} RPCs'.format(
+                'journaled:' if journaled else 'from bessd:',
+                elapsed * 1000, rpcs))
+        if not args.state_file:
+            os.unlink(state_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,22 @@
 # Copyright 2019 Intel Corporation
 
 import os
+import select
 import signal
 import socket
 import sys
 import struct
+import time
 
 import iptools
 import json
 import psutil
-from pyroute2 import IPDB
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR, RTMGRP_LINK
 
 
 def exit(code, msg):
@@ -19,18 +26,54 @@ def exit(code, msg):
     sys.exit(code)
 
 
-def getpid(process_name):
-    for proc in psutil.process_iter(attrs=['pid', 'name']):
-        if process_name == proc.info['name']:
-            return proc.info['pid']
+def _pids():
+    # Reading /proc directly is an order of magnitude cheaper than a
+    # psutil.Process per pid on hosts running thousands of processes
+    return [int(pid) for pid in os.listdir('/proc') if pid.isdigit()]
+
 
+def _cmdline(pid):
+    with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+        return f.read().decode(errors='replace').split('\0')
 
-def getpythonpid(process_name):
-    for proc in psutil.process_iter(attrs=['pid', 'cmdline']):
-        if len(proc.info['cmdline']) < 2:
+
+def getpid(process_name):
+    for pid in _pids():
+        try:
+            with open('/proc/{}/comm'.format(pid)) as f:
+                name = f.read().strip()
+            # comm is cut at 15 chars, take the long name from argv[0]
+            if len(name) == 15:
+                name = os.path.basename(_cmdline(pid)[0])
+        except IOError:
             continue
-        if process_name in proc.info['cmdline'][1] and 'python' in proc.info['cmdline'][0]:
-            return proc.info['pid']
+        if process_name == name:
+            return pid
+
+
+def _is_python(cmdline, process_name):
+    return (len(cmdline) >= 2 and process_name in cmdline[1] and
+            'python' in cmdline[0])
+
+
+def getpythonpid(process_name, pidfile=None):
+    # A pidfile is trusted only while its pid still runs the script,
+    # otherwise (stale, or in another container's /tmp) scan /proc
+    if pidfile:
+        try:
+            with open(pidfile) as f:
+                pid = int(f.read())
+            if _is_python(_cmdline(pid), process_name):
+                return pid
+        except (IOError, ValueError):
+            pass
+    for pid in _pids():
+        try:
+            cmdline = _cmdline(pid)
+        except IOError:
+            continue
+        if _is_python(cmdline, process_name):
+            return pid
     return
 
 
@@ -52,9 +95,87 @@ def get_env(varname, default=None):
             exit(1, 'Empty env var {}'.format(varname))
 
 
+class InterfaceInventory:
+    """Links and IPv4 addresses of the host, from a single netlink dump.
+
+    The dump is taken on first use and answered from until a link or
+    address event arrives on a socket subscribed to them, which is polled
+    without blocking on every lookup. No threads are started, and only
+    that socket is kept open.
+    """
+    def __init__(self):
+        # {ifname: {'index', 'address', 'ifalias', 'link'}}
+        self.links = {}
+        # {ifindex: ifname}
+        self.names = {}
+        # {ifname: [ipv4 address, ...]}
+        self.ipv4 = {}
+        self.events = None
+        self.stale = True
+
+    def refresh(self):
+        # Subscribe first, so that a change during the dump is not missed
+        if self.events is None:
+            self.events = IPRoute()
+            self.events.bind(groups=RTMGRP_LINK | RTMGRP_IPV4_IFADDR)
+        self.drain()
+        with IPRoute() as ipr:
+            links = ipr.get_links()
+            addrs = ipr.get_addr(family=socket.AF_INET)
+        self.links = {}
+        self.names = {}
+        self.ipv4 = {}
+        for msg in links:
+            name = msg.get_attr('IFLA_IFNAME')
+            self.links[name] = {'index': msg['index'],
+                                'address': msg.get_attr('IFLA_ADDRESS'),
+                                'ifalias': msg.get_attr('IFLA_IFALIAS'),
+                                'link': msg.get_attr('IFLA_LINK')}
+            self.names[msg['index']] = name
+            self.ipv4[name] = []
+        for msg in addrs:
+            name = self.names.get(msg['index'])
+            if name is not None:
+                self.ipv4[name].append(msg.get_attr('IFA_LOCAL') or
+                                       msg.get_attr('IFA_ADDRESS'))
+        self.stale = False
+
+    def drain(self):
+        # Returns whether any link or address event was pending
+        fd = self.events.fileno()
+        changed = False
+        while select.select([fd], [], [], 0)[0]:
+            changed = True
+            try:
+                self.events.get()
+            except OSError:
+                # Overrun, the dump is out of date either way
+                pass
+        return changed
+
+    def link(self, name):
+        if self.stale or self.drain():
+            self.refresh()
+        return self.links[name]
+
+    def close(self):
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+        self.stale = True
+
+
+# Shared by the *_by_interface helpers below
+_interfaces = InterfaceInventory()
+
+
+def refresh_interfaces():
+    _interfaces.refresh()
+
+
 def ips_by_interface(name):
-    ipdb = IPDB()
-    return [ipobj[0] for ipobj in ipdb.interfaces[name]['ipaddr'].ipv4]
+    _interfaces.link(name)
+    return list(_interfaces.ipv4[name])
 
 
 def atoh(ip):
@@ -62,13 +183,11 @@ def atoh(ip):
 
 
 def alias_by_interface(name):
-    ipdb = IPDB()
-    return ipdb.interfaces[name]['ifalias']
+    return _interfaces.link(name)['ifalias']
 
 
 def mac_by_interface(name):
-    ipdb = IPDB()
-    return ipdb.interfaces[name]['address']
+    return _interfaces.link(name)['address']
 
 
 def mac2hex(mac):
@@ -76,16 +195,108 @@ def mac2hex(mac):
 
 
 def peer_by_interface(name):
-    ipdb = IPDB()
     try:
-        peer_idx = ipdb.interfaces[name]['link']
-        peer_name = ipdb.interfaces[peer_idx]['ifname']
+        peer_idx = _interfaces.link(name)['link']
+        peer_name = _interfaces.names[peer_idx]
     except:
         raise Exception('veth interface {} does not exist'.format(name))
     else:
         return peer_name
 
 
+def numa_node_by_interface(name):
+    # A DPDK-bound NIC has no netdev left, only the PCI address kept in
+    # the alias of its mirror veth. -1 if unknown (virtual or single node)
+    paths = ['/sys/class/net/{}/device/numa_node'.format(name)]
+    try:
+        pci = alias_by_interface(name)
+    except KeyError:
+        pci = None
+    if pci is not None:
+        paths.insert(0, '/sys/bus/pci/devices/{}/numa_node'.format(pci))
+    for path in paths:
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            continue
+    return -1
+
+
+def rx_queues_by_interface(name):
+    # RX queues the kernel driver has enabled, 0 if unknown
+    try:
+        return len([q for q in os.listdir('/sys/class/net/{}/queues'.format(name))
+                    if q.startswith('rx-')])
+    except OSError:
+        return 0
+
+
+def dpdk_pci_devices():
+    # [[PCI address, vendor:device]] bound to a DPDK driver, in address
+    # order as DPDK probes them
+    devices = []
+    for driver in ['vfio-pci', 'igb_uio', 'uio_pci_generic']:
+        path = '/sys/bus/pci/drivers/{}'.format(driver)
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            continue
+        for pci in entries:
+            if pci.count(':') != 2:
+                continue
+            ids = []
+            for attr in 'vendor', 'device':
+                with open(os.path.join(path, pci, attr)) as f:
+                    ids.append(f.read().strip())
+            devices.append([pci, ':'.join(ids)])
+    return sorted(devices)
+
+
+def parse_cpulist(cpulist):
+    # '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for span in cpulist.strip().split(','):
+        if span:
+            first, _, last = span.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def cpus_by_numa_node():
+    # {node: [cpu, ...]}, empty if the kernel does not expose NUMA
+    nodes = {}
+    path = '/sys/devices/system/node'
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return nodes
+    for entry in entries:
+        if entry.startswith('node') and entry[4:].isdigit():
+            with open(os.path.join(path, entry, 'cpulist')) as f:
+                nodes[int(entry[4:])] = parse_cpulist(f.read())
+    return nodes
+
+
+def free_hugepages_by_numa_node():
+    # {node: free hugepage bytes over all page sizes}, node -1 holding the
+    # host total if the kernel does not expose NUMA
+    free = {}
+    dirs = [('/sys/devices/system/node/node{}/hugepages'.format(node), node)
+            for node in cpus_by_numa_node()] or [('/sys/kernel/mm/hugepages', -1)]
+    for path, node in dirs:
+        free[node] = 0
+        try:
+            sizes = os.listdir(path)
+        except OSError:
+            continue
+        for size in sizes:
+            # hugepages-2048kB
+            with open(os.path.join(path, size, 'free_hugepages')) as f:
+                free[node] += int(f.read()) * int(size[10:-2]) * 1024
+    return free
+
+
 def aton(ip):
     return socket.inet_aton(ip)
 
@@ -118,6 +329,58 @@ def ip2long(ip):
     return iptools.ipv4.ip2long(ip)
 
 
+# Bulk counterparts of the helpers above, for generating and checking
+# rules for many UEs at once. They return numpy uint32 arrays when numpy
+# is installed and lists of ints otherwise; inputs may be either.
+
+def ips2long(ips):
+    # inet_aton on each address, but one unpack for all of them
+    packed = b''.join(map(socket.inet_aton, ips))
+    if np is not None:
+        return np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+    return list(struct.unpack('>{}I'.format(len(packed) // 4), packed))
+
+
+def long2ips(longs):
+    if np is not None:
+        packed = np.asarray(longs, dtype='>u4').tobytes()
+    else:
+        packed = struct.pack('>{}I'.format(len(longs)), *longs)
+    # Strings are built one by one either way, this only avoids slicing
+    return [socket.inet_ntoa(ip) for (ip,) in struct.iter_unpack('4s', packed)]
+
+
+def ip_range(start_ip, count):
+    # count consecutive addresses from start_ip, e.g. the UE pool
+    start = ip2long(start_ip)
+    if start + count > 1 << 32:
+        raise ValueError('{} + {} addresses overflows IPv4'.format(start_ip, count))
+    if np is not None:
+        return np.arange(start, start + count, dtype=np.uint32)
+    return list(range(start, start + count))
+
+
+def cidrs2blocks(cidrs):
+    # ['10.0.0.0/8', ...] -> (network addresses, netmasks)
+    pairs = [cidr.split('/') for cidr in cidrs]
+    networks = ips2long([ip for ip, _ in pairs])
+    prefixes = [int(prefix) for _, prefix in pairs]
+    if np is not None:
+        prefixes = np.array(prefixes, dtype=np.uint64)
+        masks = ((0xffffffff << (32 - prefixes)) & 0xffffffff).astype(np.uint32)
+        return networks & masks, masks
+    masks = [(0xffffffff << (32 - p)) & 0xffffffff for p in prefixes]
+    return [n & m for n, m in zip(networks, masks)], masks
+
+
+def ips_in_cidr(longs, cidr):
+    # Whether each address (as from ips2long/ip_range) falls within cidr
+    (network,), (mask,) = cidrs2blocks([cidr])
+    if np is not None:
+        return (np.asarray(longs, dtype=np.uint32) & mask) == network
+    return [(ip & mask) == network for ip in longs]
+
+
 def get_process_affinity():
     return psutil.Process().cpu_affinity()
 
@@ -126,7 +389,42 @@ def set_process_affinity(pid, cpus):
     psutil.Process(pid).cpu_affinity(cpus)
 
 
-def set_process_affinity_all(cpus):
-    for pid in psutil.pids():
-        for thread in psutil.Process(pid).threads():
-            set_process_affinity(thread.id, cpus)
+def _set_thread_affinity(pids, cpus):
+    # Returns the number of threads pinned
+    pinned = 0
+    for pid in pids:
+        try:
+            tids = os.listdir('/proc/{}/task'.format(pid))
+        except OSError:
+            continue
+        for tid in tids:
+            try:
+                os.sched_setaffinity(int(tid), cpus)
+                pinned += 1
+            except OSError:
+                # Exited meanwhile, or a kernel thread bound to its CPU
+                pass
+    return pinned
+
+
+def set_process_affinity_all(cpus, cgroups=None):
+    """Confine every task but the bessd workers to cpus.
+
+    Without cgroups each thread of each process is pinned. With a list of
+    cpuset cgroup directories (e.g. /sys/fs/cgroup/system.slice) their
+    cpuset.cpus is narrowed instead, one write moving all of their tasks,
+    and only this process and bessd, which workers are later carved from,
+    are pinned thread by thread. Returns the number of threads pinned.
+    """
+    if cgroups:
+        try:
+            for path in cgroups:
+                with open(os.path.join(path, 'cpuset.cpus'), 'w') as f:
+                    f.write(','.join(str(cpu) for cpu in cpus))
+        except IOError as e:
+            print('Unable to set cpuset of {}: {}. Pinning every thread'
+                  ' instead'.format(path, e))
+        else:
+            pids = [os.getpid(), getpid('bessd')]
+            return _set_thread_affinity([p for p in pids if p], cpus)
+    return _set_thread_affinity(_pids(), cpus)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2022-present Open Networking Foundation
+
+"""Benchmark of the bulk IPv4 helpers in utils.py against per-address loops.
+
+Generates --sessions UE addresses from a pool, converts them to and from
+dotted strings, and checks them against the pool prefix, once with the
+per-address helpers in a Python loop and once with the bulk helpers.
+Run with and without numpy installed to compare both bulk backends.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conf.utils as utils
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, (time.time() - start) * 1000
+
+
+def loop_range(start_ip, count):
+    start = utils.ip2long(start_ip)
+    return [start + i for i in range(count)]
+
+
+def loop_to_ips(longs):
+    return [utils.iptools.ipv4.long2ip(ip) for ip in longs]
+
+
+def loop_to_longs(ips):
+    return [utils.ip2long(ip) for ip in ips]
+
+
+def loop_in_cidr(longs, cidr):
+    network, netmask = utils.cidr2netmask(cidr)
+    mask = utils.ip2long(netmask)
+    network = utils.ip2long(network) & mask
+    return [(ip & mask) == network for ip in longs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000000,
+                        help='number of UE addresses')
+    parser.add_argument('--pool', type=str, default='16.0.0.0/8',
+                        help='UE address pool')
+    args = parser.parse_args()
+
+    start_ip = args.pool.split('/')[0]
+    backend = 'numpy {}'.format(utils.np.__version__) if utils.np is not None else 'no numpy'
+    print('{} sessions in {}, bulk helpers with {}'.format(
+        args.sessions, args.pool, backend))
+    print('{:<22}{:>12}{:>12}{:>10}'.format('step', 'loop ms', 'bulk ms', 'speedup'))
+
+    steps = [
+        ('generate range', (loop_range, start_ip, args.sessions),
+         (utils.ip_range, start_ip, args.sessions)),
+    ]
+    longs, _ = timed(utils.ip_range, start_ip, args.sessions)
+    steps.append(('to dotted strings', (loop_to_ips, longs), (utils.long2ips, longs)))
+    ips, _ = timed(utils.long2ips, longs)
+    steps.append(('from dotted strings', (loop_to_longs, ips), (utils.ips2long, ips)))
+    steps.append(('check in pool', (loop_in_cidr, longs, args.pool),
+                  (utils.ips_in_cidr, longs, args.pool)))
+
+    for name, loop, bulk in steps:
+        expected, loop_ms = timed(*loop)
+        result, bulk_ms = timed(*bulk)
+        if list(result) != list(expected):
+            raise Exception('{}: bulk result differs from loop'.format(name))
+        print('{:<22}{:>12.1f}{:>12.1f}{:>9.1f}x'.format(
+            name, loop_ms, bulk_ms, loop_ms / max(bulk_ms, 1e-3)))
+
+
+if __name__ == '__main__':
+    main()